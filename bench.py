@@ -0,0 +1,835 @@
+#!/usr/bin/env python
+"""Measures NEB's throughput against local fakes of the services it talks to.
+
+A fake homeserver serves scripted /sync batches and records the messages NEB
+sends, a fake JIRA answers issue searches, and stand-ins for Github and
+Alertmanager post bursts of webhooks. NEB runs in this process with the
+bundled Base64, JIRA, Github and Prometheus plugins, unchanged, so the numbers
+include the real HTTP round trips to the fakes.
+
+    python bench.py --rooms 100 --messages 3000 --github-pushes 200
+
+The results are printed as JSON:
+
+    messages: events/sec processed from /sync, and the p50/p99 latency from an
+        event being served in /sync to NEB's reply being sent, for commands
+        and for JIRA issue expansion.
+    github, alertmanager: webhook response latency, and the fan-out time from
+        a webhook being posted to its message reaching every tracking room.
+        Alerts are grouped into digests for --alert-window-s seconds, the
+        Prometheus plugin's default; run again with 0 to time them ungrouped.
+
+along with the memory NEB is using after each stage.
+"""
+import argparse
+import base64
+import BaseHTTPServer
+import hashlib
+import hmac
+import json
+import os
+import Queue
+import re
+import resource
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+import logging
+
+from matrix_client.api import MatrixHttpApi
+from neb.engine import Engine
+from neb.matrix import MatrixConfig
+from neb.outbox import percentiles
+from plugins.b64 import Base64Plugin
+from plugins.github import GithubPlugin
+from plugins.jira import JiraPlugin
+from plugins.prometheus import PrometheusPlugin
+import requests
+
+log = logging.getLogger(name=__name__)
+
+# markers put in the traffic so replies can be matched to what caused them
+TOKEN_REGEX = re.compile(r"bench-(?:cmd|push|alert)-\d+|BENCH-\d+")
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class FakeService(object):
+    """A JSON HTTP server on a free local port, run on its own threads.
+
+    Subclasses implement handle().
+    """
+
+    def __init__(self):
+        service = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep connections alive
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def _handle(self, method):
+                parsed = urlparse.urlparse(self.path)
+                length = int(self.headers.getheader("Content-Length") or 0)
+                body = self.rfile.read(length) if length else ""
+                code, response = service.handle(
+                    method,
+                    parsed.path,
+                    dict(urlparse.parse_qsl(parsed.query)),
+                    body
+                )
+                data = json.dumps(response)
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_port
+        t = threading.Thread(
+            target=self.server.serve_forever, name=type(self).__name__
+        )
+        t.daemon = True
+        t.start()
+
+    def shutdown(self):
+        """Stop serving and close the listening socket."""
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, method, path, params, body):
+        """Handle a request.
+
+        Args:
+            method(str): The HTTP method.
+            path(str): The URL path.
+            params(dict): The query string parameters.
+            body(str): The request body.
+        Returns:
+            A tuple of (status code, JSON-serialisable response).
+        """
+        return (404, {"errcode": "M_UNRECOGNIZED"})
+
+
+class FakeHomeserver(FakeService):
+    """Serves queued /sync batches and records the messages which are sent."""
+
+    SEND_PATH = re.compile(r"/rooms/([^/]+)/send/([^/]+)/([^/]+)$")
+    MAX_POLL_S = 1  # the longest an empty /sync is held open for
+
+    def __init__(self):
+        super(FakeHomeserver, self).__init__()
+        self.batches = Queue.Queue()
+        self.next_batch = 0
+        self.queued = 0  # the number of batches queued
+        self.taken = 0  # the number of batches served
+        self.polled_after = 0  # the value of taken at the latest /sync
+        self.served = {
+        #    event_id : the time the event was served in /sync
+        }
+        self.sends = 0
+        self.deliveries = {
+        #    token : [number of messages containing it, first time, last time]
+        }
+        self.cond = threading.Condition()
+
+    def queue_sync(self, join=None):
+        """Queue a /sync response.
+
+        Args:
+            join(dict): The 'rooms.join' section of the response.
+        """
+        with self.cond:
+            self.queued += 1
+            self.batches.put(join or {})
+
+    def is_drained(self):
+        """Return True if /sync has been polled again since the last queued
+        batch was served, i.e. the client has processed every batch."""
+        with self.cond:
+            return self.polled_after == self.queued
+
+    def reset(self):
+        with self.cond:
+            self.served.clear()
+            self.deliveries.clear()
+            self.sends = 0
+
+    def get_deliveries(self, token):
+        """Return [count, first time, last time] for a token, or None."""
+        with self.cond:
+            return self.deliveries.get(token)
+
+    def wait_for(self, fn, timeout):
+        """Wait until fn() is True, re-checking each time a message is sent
+        or /sync is polled.
+
+        Returns:
+            bool: The final value of fn().
+        """
+        end = time.time() + timeout
+        with self.cond:
+            while not fn():
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(min(remaining, FakeHomeserver.MAX_POLL_S))
+            return True
+
+    def handle(self, method, path, params, body):
+        if path.endswith("/sync"):
+            return (200, self._sync(params))
+        match = FakeHomeserver.SEND_PATH.search(path)
+        if method == "PUT" and match:
+            return (200, self._send(urllib.unquote(match.group(1)), body))
+        if path.endswith("/filter"):
+            return (200, {"filter_id": "bench"})
+        return (200, {})
+
+    def _sync(self, params):
+        if "since" in params:
+            timeout_s = min(
+                int(params.get("timeout", 0)) / 1000.0,
+                FakeHomeserver.MAX_POLL_S
+            )
+        else:
+            timeout_s = 0  # the initial sync
+        with self.cond:
+            self.polled_after = self.taken
+            self.cond.notify_all()
+        try:
+            join = self.batches.get(timeout=timeout_s) if timeout_s else (
+                self.batches.get_nowait()
+            )
+            taken = True
+        except Queue.Empty:
+            join = {}
+            taken = False
+
+        now = time.time()
+        with self.cond:
+            if taken:
+                self.taken += 1
+            for room in join.values():
+                for event in room.get("timeline", {}).get("events", []):
+                    self.served[event["event_id"]] = now
+            self.next_batch += 1
+            next_batch = str(self.next_batch)
+        return {
+            "next_batch": next_batch,
+            "rooms": {"join": join, "invite": {}, "leave": {}}
+        }
+
+    def _send(self, room_id, body):
+        content = json.loads(body)
+        now = time.time()
+        with self.cond:
+            self.sends += 1
+            for token in set(TOKEN_REGEX.findall(content.get("body", ""))):
+                if token not in self.deliveries:
+                    self.deliveries[token] = [0, now, now]
+                self.deliveries[token][0] += 1
+                self.deliveries[token][2] = now
+            self.cond.notify_all()
+            return {"event_id": "$sent-%s" % self.sends}
+
+
+class FakeJira(FakeService):
+    """Answers JIRA issue searches with made up issues."""
+
+    JQL_KEYS = re.compile(r"key in \((.*)\)")
+
+    def __init__(self):
+        super(FakeJira, self).__init__()
+        self.searches = 0
+
+    def handle(self, method, path, params, body):
+        if path.endswith("/rest/api/2/serverInfo"):
+            return (200, {"version": "bench", "versionNumbers": [0, 0, 0]})
+        if not path.endswith("/rest/api/2/search"):
+            return (404, {})
+        self.searches += 1
+        keys = FakeJira.JQL_KEYS.match(params.get("jql", "")).group(1)
+        return (200, {
+            "issues": [
+                {
+                    "key": key,
+                    "fields": {
+                        "summary": "Benchmark issue %s" % key.split("-")[1],
+                        "status": {"name": "Open"},
+                        "priority": {"name": "Major"},
+                        "reporter": {"displayName": "Reporter"},
+                        "assignee": None
+                    }
+                }
+                for key in keys.split(",")
+            ]
+        })
+
+
+class WebhookSender(object):
+    """Posts bursts of webhooks to NEB, like a service would."""
+
+    def __init__(self, url, concurrency):
+        """
+        Args:
+            url(str): The NEB webhook URL, e.g. http://host:port/neb/github
+            concurrency(int): The number of requests to have in flight.
+        """
+        self.url = url
+        self.concurrency = concurrency
+        self.session = requests.Session()
+
+    def get_body(self, n):
+        """Return the (body, headers) for the nth request."""
+        return ("{}", {"Content-Type": "application/json"})
+
+    def get_tokens(self, n):
+        """Return the tokens in the messages the nth request causes."""
+        return []
+
+    def send_burst(self, count):
+        """Post count requests as fast as NEB accepts them.
+
+        Returns:
+            dict: request number to (time posted, response latency, status).
+        """
+        pending = Queue.Queue()
+        for n in range(count):
+            pending.put(n)
+        results = {}
+        lock = threading.Lock()
+
+        def post():
+            while True:
+                try:
+                    n = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                body, headers = self.get_body(n)
+                start = time.time()
+                try:
+                    status = self.session.post(
+                        self.url, data=body, headers=headers
+                    ).status_code
+                except requests.RequestException as e:
+                    log.warn("Failed to post webhook %s: %s", n, e)
+                    status = None
+                with lock:
+                    results[n] = (start, time.time() - start, status)
+
+        threads = [
+            threading.Thread(target=post, name="WebhookSender-%s" % i)
+            for i in range(self.concurrency)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+
+class FakeGithub(WebhookSender):
+    """Sends signed push webhooks for a single repo."""
+
+    def __init__(self, url, concurrency, repo, secret):
+        super(FakeGithub, self).__init__(url, concurrency)
+        self.repo = repo
+        self.secret = secret
+
+    def get_body(self, n):
+        commit_url = "https://github.com/%s/commit/%040x" % (self.repo, n)
+        body = json.dumps({
+            "ref": "refs/heads/master",
+            "deleted": False,
+            "repository": {"full_name": self.repo, "private": False},
+            "pusher": {"name": "bench"},
+            "head_commit": {
+                "message": "bench-push-%s" % n,
+                "url": commit_url,
+                "committer": {"name": "Bench", "username": "bench"}
+            },
+            "commits": []
+        })
+        signature = hmac.new(self.secret, body, hashlib.sha1).hexdigest()
+        return (body, {
+            "Content-Type": "application/json",
+            "X-GitHub-Event": "push",
+            "X-GitHub-Delivery": "bench-%s-%s" % (time.time(), n),
+            "X-Hub-Signature": "sha1=" + signature
+        })
+
+    def get_tokens(self, n):
+        return ["bench-push-%s" % n]
+
+
+class FakeAlertmanager(WebhookSender):
+    """Sends firing alerts which page.
+
+    Consecutive alerts share an alertname, so that the Prometheus plugin
+    groups them into digests small enough to list every alert.
+    """
+
+    GROUP_SIZE = PrometheusPlugin.DIGEST_MAX_ALERTS
+
+    def __init__(self, url, concurrency, alerts_per_request):
+        super(FakeAlertmanager, self).__init__(url, concurrency)
+        self.alerts_per_request = alerts_per_request
+        self.run_id = int(time.time() * 1000)  # so reruns aren't repeats
+
+    def get_body(self, n):
+        alerts = []
+        for i in range(self.alerts_per_request):
+            index = n * self.alerts_per_request + i
+            token = "bench-alert-%s" % index
+            alerts.append({
+                "status": "firing",
+                "fingerprint": "%s-%s" % (self.run_id, token),
+                "labels": {
+                    "alertname": "BenchAlert%s-%s" % (
+                        self.run_id, index // FakeAlertmanager.GROUP_SIZE
+                    ),
+                    "severity": "page",
+                    "instance": token
+                },
+                "annotations": {"summary": "Benchmark alert"}
+            })
+        return (json.dumps({
+            "version": "4",
+            "status": "firing",
+            "alerts": alerts
+        }), {"Content-Type": "application/json"})
+
+    def get_tokens(self, n):
+        return [
+            "bench-alert-%s" % (n * self.alerts_per_request + i)
+            for i in range(self.alerts_per_request)
+        ]
+
+
+def get_free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def get_memory():
+    """Return the current and peak resident memory of this process in MB."""
+    memory = {
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    }
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    memory["rss_mb"] = int(line.split()[1]) / 1024.0
+    except IOError:
+        pass  # not Linux
+    return memory
+
+
+class Benchmark(object):
+    """Runs NEB against the fakes and measures it."""
+
+    GITHUB_REPO = "bench/repo"
+    GITHUB_SECRET = "bench-secret"
+    JIRA_PROJECT = "BENCH"
+    USER_ID = "@neb:localhost"
+    SENDER = "@bench:localhost"
+
+    def __init__(self, args):
+        self.args = args
+        self.homeserver = FakeHomeserver()
+        self.jira = FakeJira()
+        self.room_ids = ["!bench-%s:localhost" % i for i in range(args.rooms)]
+        self.tracking_room_ids = self.room_ids[:args.tracking_rooms]
+        self.engine = None
+        self.stopping = False
+        self.webhook_url = None
+        self.event_count = 0
+
+    def setup(self):
+        """Start NEB, with every room already joined."""
+        # the plugins keep their config in the working directory
+        self._write_json("jira.json", {
+            "version": "1",
+            "url": self.jira.url,
+            "user": "bench",
+            "pass": "bench"
+        })
+        self._write_json("github.json", {
+            "version": "1",
+            "known_projects": [Benchmark.GITHUB_REPO],
+            "secret_token": Benchmark.GITHUB_SECRET,
+            "github_access_token": "bench"
+        })
+        self._write_json("prometheus.json", {
+            "version": "1",
+            "message_template": (
+                "[ALERT] {{labels.alertname}} {{labels.instance}} : "
+                "{{annotations.summary}}"
+            ),
+            "group_window_s": self.args.alert_window_s
+        })
+
+        port = get_free_port()
+        self.webhook_url = "http://127.0.0.1:%s" % port
+        config = MatrixConfig(
+            hs_url=self.homeserver.url,
+            user_id=Benchmark.USER_ID,
+            access_token="bench",
+            admins=[Benchmark.SENDER],
+            case_insensitive=False,
+            dispatch={"concurrent": self.args.concurrent_dispatch},
+            executor={"max_queue": self.args.messages + 1},
+            outbox={
+                "rate_per_s": self.args.rate_per_room,
+                "burst": self.args.rate_per_room
+            },
+            sync={"timeout_ms": 1000, "stream": self.args.stream_sync},
+            webhook={
+                "host": "127.0.0.1",
+                "port": port,
+                "max_queue": self.args.github_pushes + self.args.alerts + 1
+            }
+        )
+
+        self.homeserver.queue_sync(join=self._initial_rooms())
+        self.engine = Engine(
+            MatrixHttpApi(config.base_url, config.token), config
+        )
+        for plugin in [Base64Plugin, JiraPlugin, GithubPlugin,
+                       PrometheusPlugin]:
+            self.engine.add_plugin(plugin)
+        start = time.time()
+        self.engine.setup()
+        setup_s = time.time() - start
+
+        t = threading.Thread(target=self._sync_forever, name="Sync")
+        t.daemon = True
+        t.start()
+        self._wait_for_webhook_server()
+
+        return dict(get_memory(), setup_s=setup_s)
+
+    def bench_messages(self):
+        """Send a mix of commands, JIRA issue mentions and chatter."""
+        self.homeserver.reset()
+        batch_size = self.args.batch_size
+        expected = []
+        batches = []
+        join = {}
+        for n in range(self.args.messages):
+            room_id = self.room_ids[n % len(self.room_ids)]
+            kind = n % 3
+            if kind == 0:
+                token = "bench-cmd-%s" % n
+                body = "!b64 decode " + base64.b64encode(token)
+                expected.append(("command", "$%s" % n, token))
+            elif kind == 1:
+                token = "%s-%s" % (Benchmark.JIRA_PROJECT, n)
+                body = "Could somebody look at %s please?" % token
+                expected.append(("expand", "$%s" % n, token))
+            else:
+                body = "Just chatting about nothing in particular %s" % n
+            room = join.setdefault(room_id, {
+                "state": {"events": []},
+                "timeline": {"events": []}
+            })
+            room["timeline"]["events"].append(self._message(n, body))
+            if (n + 1) % batch_size == 0:
+                batches.append(join)
+                join = {}
+        if join:
+            batches.append(join)
+
+        start = time.time()
+        interval_s = 0
+        if self.args.message_rate:
+            interval_s = batch_size / float(self.args.message_rate)
+        for i, batch in enumerate(batches):
+            if interval_s:
+                delay_s = start + i * interval_s - time.time()
+                if delay_s > 0:
+                    time.sleep(delay_s)
+            self.homeserver.queue_sync(join=batch)
+
+        # /sync is polled with nothing queued once every batch is processed
+        self.homeserver.wait_for(self.homeserver.is_drained, self.args.timeout)
+        if self.engine.dispatcher:
+            self.engine.dispatcher.wait_idle(self.args.timeout)
+        processed_s = time.time() - start
+        replied = self.homeserver.wait_for(
+            lambda: all(self.homeserver.deliveries.get(token)
+                        for (kind, event_id, token) in expected),
+            self.args.timeout
+        )
+
+        latencies = {"command": [], "expand": []}
+        for (kind, event_id, token) in expected:
+            delivered = self.homeserver.get_deliveries(token)
+            if delivered:
+                latencies[kind].append(
+                    delivered[1] - self.homeserver.served[event_id]
+                )
+        return dict(
+            get_memory(),
+            events=self.args.messages,
+            processed_s=processed_s,
+            events_per_s=self.args.messages / processed_s,
+            command_latency_s=self._percentiles(latencies["command"]),
+            expand_latency_s=self._percentiles(latencies["expand"]),
+            missing_replies=len(expected) - sum(
+                len(l) for l in latencies.values()
+            ),
+            complete=replied,
+            jira_searches=self.jira.searches
+        )
+
+    def bench_webhooks(self, sender, count):
+        """Post a burst of webhooks and wait for them to reach every room."""
+        self.homeserver.reset()
+        fan_out = len(self.tracking_room_ids)
+        tokens = dict((n, sender.get_tokens(n)) for n in range(count))
+        start = time.time()
+        results = sender.send_burst(count)
+        accepted_s = time.time() - start
+        complete = self.homeserver.wait_for(
+            lambda: all(
+                (self.homeserver.deliveries.get(token) or [0])[0] >= fan_out
+                for n in tokens for token in tokens[n]
+            ),
+            self.args.timeout
+        )
+
+        fan_out_latencies = []
+        for n in tokens:
+            delivered = [
+                self.homeserver.get_deliveries(token) for token in tokens[n]
+            ]
+            if all(d and d[0] >= fan_out for d in delivered):
+                fan_out_latencies.append(
+                    max(d[2] for d in delivered) - results[n][0]
+                )
+        total_s = time.time() - start
+        statuses = {}
+        for (posted, latency, status) in results.values():
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        return dict(
+            get_memory(),
+            requests=count,
+            rooms=fan_out,
+            accepted_s=accepted_s,
+            requests_per_s=count / accepted_s if accepted_s else None,
+            statuses=statuses,
+            response_latency_s=self._percentiles(
+                [r[1] for r in results.values()]
+            ),
+            fan_out_latency_s=self._percentiles(fan_out_latencies),
+            fan_out_s=total_s if complete else None,
+            complete=complete,
+            messages_sent=self.homeserver.sends
+        )
+
+    def run(self):
+        results = {"setup": self.setup()}
+        if self.args.messages:
+            results["messages"] = self.bench_messages()
+        if self.args.github_pushes:
+            results["github"] = self.bench_webhooks(
+                FakeGithub(
+                    self.webhook_url + "/neb/github",
+                    self.args.concurrency,
+                    Benchmark.GITHUB_REPO,
+                    Benchmark.GITHUB_SECRET
+                ),
+                self.args.github_pushes
+            )
+        if self.args.alerts:
+            results["alertmanager"] = dict(
+                self.bench_webhooks(
+                    FakeAlertmanager(
+                        self.webhook_url + "/neb/prometheus",
+                        self.args.concurrency,
+                        self.args.alerts_per_request
+                    ),
+                    self.args.alerts
+                ),
+                window_s=self.args.alert_window_s
+            )
+        return results
+
+    def stop(self):
+        """Stop the fake services."""
+        self.stopping = True
+        for service in [self.homeserver, self.jira]:
+            service.shutdown()
+
+    def _sync_forever(self):
+        while True:
+            try:
+                self.engine.event_loop()
+            except Exception as e:
+                if self.stopping:
+                    return  # the fake homeserver has gone
+                log.exception(e)
+                time.sleep(1)
+
+    def _wait_for_webhook_server(self):
+        end = time.time() + self.args.timeout
+        while time.time() < end:
+            try:
+                requests.get(self.webhook_url + "/_neb/stats")
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise Exception("The webhook server didn't start")
+
+    def _initial_rooms(self):
+        join = {}
+        for room_id in self.room_ids:
+            state = [self._state(
+                JiraPlugin.TYPE_EXPAND,
+                {"projects": [Benchmark.JIRA_PROJECT]}
+            )]
+            if room_id in self.tracking_room_ids:
+                state.append(self._state(
+                    GithubPlugin.TYPE_TRACK,
+                    {"projects": [Benchmark.GITHUB_REPO]}
+                ))
+                state.append(self._state(
+                    PrometheusPlugin.TYPE_TRACK,
+                    {"matchers": ["severity=page"]}
+                ))
+            join[room_id] = {
+                "state": {"events": state},
+                "timeline": {"events": []}
+            }
+        return join
+
+    def _state(self, event_type, content):
+        self.event_count += 1
+        return {
+            "type": event_type,
+            "state_key": "",
+            "sender": Benchmark.SENDER,
+            "event_id": "$state-%s" % self.event_count,
+            "content": content
+        }
+
+    def _message(self, n, body):
+        return {
+            "type": "m.room.message",
+            "sender": Benchmark.SENDER,
+            "event_id": "$%s" % n,
+            "content": {"msgtype": "m.text", "body": body}
+        }
+
+    def _percentiles(self, samples):
+        return percentiles(samples, [50, 99])
+
+    def _write_json(self, path, data):
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+
+def main():
+    a = argparse.ArgumentParser(
+        "Benchmarks NEB against local fake Matrix, JIRA, Github and "
+        "Alertmanager services."
+    )
+    a.add_argument("--rooms", type=int, default=50,
+                   help="The number of rooms NEB is in.")
+    a.add_argument("--tracking-rooms", type=int,
+                   help="The number of rooms which track the Github repo and "
+                   "page alerts. Defaults to every room.")
+    a.add_argument("--messages", type=int, default=3000,
+                   help="The number of messages to send: a third are "
+                   "commands, a third mention JIRA issues.")
+    a.add_argument("--batch-size", type=int, default=100,
+                   help="The number of messages in each /sync response.")
+    a.add_argument("--message-rate", type=float, default=0,
+                   help="Messages per second to serve, or 0 for as fast as "
+                   "NEB syncs.")
+    a.add_argument("--github-pushes", type=int, default=100,
+                   help="The number of Github push webhooks to send.")
+    a.add_argument("--alerts", type=int, default=100,
+                   help="The number of Alertmanager webhooks to send.")
+    a.add_argument("--alerts-per-request", type=int, default=1)
+    a.add_argument("--alert-window-s", type=float,
+                   default=PrometheusPlugin.GROUP_WINDOW_S,
+                   help="How long the Prometheus plugin groups alerts for, "
+                   "or 0 to send them one at a time.")
+    a.add_argument("--concurrency", type=int, default=8,
+                   help="The number of webhooks to have in flight at once.")
+    a.add_argument("--rate-per-room", type=float, default=1000,
+                   help="The outbox rate limit per room, in messages/sec.")
+    a.add_argument("--concurrent-dispatch", action="store_true",
+                   help="Process events on the dispatcher's worker pool.")
+    a.add_argument("--stream-sync", action="store_true",
+                   help="Parse /sync responses incrementally.")
+    a.add_argument("--timeout", type=float, default=120,
+                   help="The max seconds to wait for each stage to finish.")
+    a.add_argument("--keep", action="store_true",
+                   help="Keep the working directory with the plugin config.")
+    a.add_argument("-v", "--verbose", action="store_true")
+    args = a.parse_args()
+    if args.tracking_rooms is None:
+        args.tracking_rooms = args.rooms
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.ERROR,
+        format="%(asctime)s %(levelname)s: %(message)s"
+    )
+
+    workdir = tempfile.mkdtemp(prefix="neb-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    benchmark = Benchmark(args)
+    status = 0
+    try:
+        results = benchmark.run()
+        print json.dumps(results, indent=4, sort_keys=True)
+    except Exception as e:
+        log.exception(e)
+        status = 1
+    finally:
+        benchmark.stop()
+        os.chdir(cwd)
+        if args.keep:
+            print "Working directory: %s" % workdir
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # NEB's threads run forever, so exit without waiting for them, rather
+    # than have them fail as the interpreter tears down their modules.
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache(object):
+    """A bounded LRU cache whose entries expire after a fixed time."""
+
+    def __init__(self, max_size=1000, ttl_s=300):
+        """Create the cache.
+
+        Args:
+            max_size(int): The max number of entries. The least recently used
+                entry is evicted when a new one is added to a full cache.
+            ttl_s(float): The number of seconds an entry is valid for.
+        """
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self.entries = OrderedDict()  # key : (expires_at, value)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Return the value for the key, or default if it is missing or
+        expired."""
+        with self.lock:
+            try:
+                expires_at, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expires_at < time.time():
+                self.misses += 1
+                return default
+
+            self.entries[key] = (expires_at, value)  # most recently used
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time() + self.ttl_s, value)
+
+    def add(self, key, value=True):
+        """Set the value for the key unless it already has a live value.
+
+        Returns:
+            bool: True if the value was set, False if the key was present.
+        """
+        with self.lock:
+            try:
+                expires_at, existing = self.entries.pop(key)
+                if expires_at >= time.time():
+                    self.entries[key] = (expires_at, existing)
+                    self.hits += 1
+                    return False
+            except KeyError:
+                pass
+            self.misses += 1
+            while len(self.entries) >= self.max_size:
+                self.entries.popitem(last=False)
+            self.entries[key] = (time.time() + self.ttl_s, value)
+            return True
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def get_stats(self):
+        """Return a dict with the size of the cache and hit/miss counts."""
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses
+            }
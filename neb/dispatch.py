@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Concurrent event dispatch which keeps events in order within a room.
+
+Each room has its own FIFO of pending events. A room is handed to at most one
+worker at a time, so events in a room are processed in the order the sync
+returned them, whereas a slow command in one room doesn't hold up any other.
+"""
+from collections import deque
+from Queue import Queue
+import threading
+
+import logging as log
+
+
+class RoomDispatcher(object):
+    """Runs a handler for events on a pool of worker threads."""
+
+    WORKERS = 8
+    # the max number of events a worker will process for a single room before
+    # letting other rooms have a turn.
+    BATCH_SIZE = 10
+
+    def __init__(self, handler, workers=WORKERS):
+        """Start the dispatcher.
+
+        Args:
+            handler(fn): The function to call with each event.
+            workers(int): The number of worker threads to run.
+        """
+        self.handler = handler
+        self.pending = {
+        #    room_id : deque of events
+        }
+        self.ready = Queue()  # room IDs with pending events and no worker
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.in_flight = 0
+
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._work, name="RoomDispatcher-%s" % i
+            )
+            t.daemon = True
+            t.start()
+
+    def dispatch(self, room_id, event):
+        """Queue an event for processing after any earlier events in the room.
+
+        Args:
+            room_id(str): The room the event belongs to.
+            event(dict): The event to pass to the handler.
+        """
+        with self.lock:
+            self.in_flight += 1
+            if room_id in self.pending:
+                # a worker has this room already, or it is waiting for one.
+                self.pending[room_id].append(event)
+                return
+            self.pending[room_id] = deque([event])
+        self.ready.put(room_id)
+
+    def is_idle(self):
+        """Return True if there are no queued or running events."""
+        with self.lock:
+            return self.in_flight == 0
+
+    def wait_idle(self, timeout=None):
+        """Block until all queued events have been processed.
+
+        Args:
+            timeout(float): The max number of seconds to wait for.
+        Returns:
+            bool: True if the dispatcher is idle.
+        """
+        with self.lock:
+            if self.in_flight and timeout != 0:
+                self.idle.wait(timeout)
+            return self.in_flight == 0
+
+    def queue_depth(self):
+        """Return the number of events which have not finished processing."""
+        return self.in_flight
+
+    def _work(self):
+        while True:
+            room_id = self.ready.get()
+            for i in range(RoomDispatcher.BATCH_SIZE):
+                with self.lock:
+                    events = self.pending[room_id]
+                    if not events:
+                        del self.pending[room_id]
+                        break
+                    event = events.popleft()
+
+                try:
+                    self.handler(event)
+                except Exception as e:
+                    log.exception(e)
+
+                with self.lock:
+                    self.in_flight -= 1
+                    if self.in_flight == 0:
+                        self.idle.notify_all()
+            else:
+                # this room is busy; put it to the back of the line.
+                with self.lock:
+                    if self.pending[room_id]:
+                        self.ready.put(room_id)
+                    else:
+                        del self.pending[room_id]
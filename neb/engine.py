@@ -1,26 +1,116 @@
 from matrix_client.api import MatrixRequestError
 from neb import NebError
-from neb.plugins import CommandNotFoundError
-from neb.webhook import NebHookServer
+from neb import metrics
+from neb.dispatch import RoomDispatcher
+from neb.executor import PluginExecutor
+from neb.httpclient import HttpClient
+from neb.outbox import Outbox
+from neb.plugins import CommandNotFoundError, compile_commands, overrides
+from neb.spool import Spool
+from neb.state import RoomContextStore
+from neb.storage import Checkpoint, KeyValueStore
+from neb.triggers import MessageRouter
+from neb import syncstream
+from neb.webhook import NebHookServer, WebhookPipeline
 
 import json
 import logging as log
-import pprint
+import time
+import urllib
+
+SYNC_SECONDS = metrics.histogram(
+    "neb_sync_duration_seconds",
+    "The time each /sync took to return and be processed, including the "
+    "long-poll.",
+    buckets=[0.1, 0.5, 1, 5, 10, 30, 35, 45, 60, 120]
+)
+SYNC_EVENTS = metrics.histogram(
+    "neb_sync_events",
+    "The number of events in each /sync response.",
+    buckets=[0, 1, 10, 50, 100, 500, 1000, 5000, 10000]
+)
+SYNC_BYTES = metrics.histogram(
+    "neb_sync_response_bytes",
+    "The size of each streamed /sync response.",
+    buckets=[1024, 10240, 102400, 1048576, 10485760, 104857600]
+)
+EVENTS = metrics.counter(
+    "neb_events_total", "Events processed, by type.", ["type"]
+)
 
 
 class Engine(object):
     """Orchestrates plugins and the matrix API/endpoints."""
     PREFIX = "!"
 
+    SYNC_TIMEOUT_MS = 30000
+    TIMELINE_LIMIT = 50
+
     def __init__(self, matrix_api, config):
         self.plugin_cls = {}
         self.plugins = {}
         self.config = config
         self.matrix = matrix_api
         self.sync_token = None  # set later by initial sync
+        self.sync_filter = None  # set later from what the plugins consume
+        self.sync_events = 0  # the number of events in the current /sync
+        # the room state which plugins have subscribed to
+        self.rooms = RoomContextStore([])
+        self.dispatcher = None  # set if events are processed concurrently
+        # picks the plugins to pass non-command messages to
+        self.msg_router = MessageRouter(self.rooms)
+        # the plugins to call on_event for, set up from get_event_types()
+        self.event_handlers = {
+        #    event_type : [plugin_name]
+        }
+        self.all_event_plugins = []  # plugins which want every event type
+        # runs plugin code off the sync path
+        self.executor = PluginExecutor(config.executor)
+        # shared by all plugins for outbound HTTP requests
+        self.http = HttpClient(config.http)
+        # keeps accepted webhooks and queued messages across restarts
+        self.spool = None
+        if config.spool.get("path"):
+            self.spool = Spool(
+                config.spool["path"],
+                segment_bytes=config.spool.get(
+                    "segment_bytes", Spool.SEGMENT_BYTES
+                )
+            )
+        # all messages to rooms are sent through this
+        self.outbox = Outbox(matrix_api, config.outbox, spool=self.spool)
+        self.checkpoint = None
+        if config.checkpoint.get("path"):
+            self.checkpoint = Checkpoint(
+                config.checkpoint["path"],
+                interval_s=config.checkpoint.get(
+                    "interval_s", Checkpoint.INTERVAL_S
+                )
+            )
 
     def setup(self):
-        self.webhook = NebHookServer(8500)
+        if self.config.dispatch.get("concurrent"):
+            # keep long-polling /sync while commands run, one room at a time.
+            self.dispatcher = RoomDispatcher(
+                self.event_proc,
+                workers=self.config.dispatch.get(
+                    "workers", RoomDispatcher.WORKERS
+                )
+            )
+
+        self.webhook = NebHookServer(
+            self.config.webhook.get("port", NebHookServer.PORT),
+            WebhookPipeline(self.config.webhook, spool=self.spool),
+            host=self.config.webhook.get("host", NebHookServer.HOST),
+            config=self.config.webhook
+        )
+        self.webhook.add_stats("outbox", self.outbox.get_stats)
+        self.webhook.add_stats("http", self.http.get_stats)
+        metrics.QUEUE_DEPTH.labels("outbox").set_function(self.outbox.queue_depth)
+        if self.dispatcher:
+            metrics.QUEUE_DEPTH.labels("dispatch").set_function(
+                self.dispatcher.queue_depth
+            )
         self.webhook.daemon = True
         self.webhook.start()
 
@@ -29,20 +119,91 @@ class Engine(object):
             self.plugins[cls_name] = self.plugin_cls[cls_name](
                 self.matrix,
                 self.config,
-                self.webhook
+                self.webhook,
+                http=self.http,
+                outbox=self.outbox,
+                room_store=self.rooms,
+                spool=self.spool
             )
+            self.msg_router.add_plugin(cls_name, self.plugins[cls_name])
+            self.add_event_handler(cls_name, self.plugins[cls_name])
+
+        if self.config.sync.get("filter", True):
+            self.sync_filter = self._upload_sync_filter(self.build_sync_filter())
+
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = self.checkpoint.load()
+
+        if checkpoint:
+            # carry on from where we left off, including any events which
+            # were sent whilst we were down.
+            log.info("Resuming from checkpoint at %s", checkpoint["next_batch"])
+            self.sync_token = checkpoint["next_batch"]
+            self.rooms.restore(checkpoint["rooms"])
+            for plugin_name in self.plugins:
+                self.plugins[plugin_name].on_restore(
+                    checkpoint["plugins"].get(plugin_name)
+                )
+        else:
+            sync = self.sync(initial_sync=True)
+            log.debug("Notifying plugins of initial sync results")
+            for plugin_name in self.plugins:
+                self.plugins[plugin_name].on_sync(sync)
+            self.save_checkpoint()
 
-        sync = self.matrix.sync(timeout_ms=30000, since=self.sync_token)
-        self.parse_sync(sync, initial_sync=True)
-        log.debug("Notifying plugins of initial sync results")
         for plugin_name in self.plugins:
             plugin = self.plugins[plugin_name]
-            plugin.on_sync(sync)
-
             # see if this plugin needs a webhook
             if plugin.get_webhook_key():
                 self.webhook.set_plugin(plugin.get_webhook_key(), plugin)
 
+        if self.spool:
+            self.replay_spool()
+        # webhooks which arrived whilst starting up were queued behind the
+        # ones being replayed
+        self.webhook.pipeline.start()
+
+    def add_event_handler(self, name, plugin):
+        """Subscribe a plugin's on_event to the event types it consumes.
+
+        Args:
+            name(str): The plugin name.
+            plugin(PluginInterface): The plugin.
+        """
+        if not overrides(plugin, "on_event"):
+            return
+        types = plugin.get_event_types()
+        if types is None:
+            self.all_event_plugins.append(name)
+            return
+        for event_type in types:
+            self.event_handlers.setdefault(event_type, []).append(name)
+
+    def replay_spool(self):
+        """Deliver the webhooks and messages which were queued last time.
+
+        Webhooks are processed one at a time, in the order they arrived.
+        """
+        count = 0
+        for (spool_id, kind, data) in self.spool.replay():
+            count += 1
+            if kind == Outbox.SPOOL_KIND:
+                self.outbox.send_content(
+                    data["room_id"], data["content"], spool_id=spool_id
+                )
+            elif kind == WebhookPipeline.SPOOL_KIND:
+                self.webhook.replay(spool_id, data)
+            elif kind.split(".")[0] in self.plugins:
+                self.plugins[kind.split(".")[0]].on_spool_replay(
+                    spool_id, kind, data
+                )
+            else:
+                log.error("Unknown spool entry %s: %s", spool_id, kind)
+                self.spool.ack(spool_id)
+        if count:
+            log.info("Replayed %s entries from the spool", count)
+
     def _help(self):
         return (
             "Installed plugins: %s - Type '%shelp <plugin_name>' for more." %
@@ -54,6 +215,8 @@ class Engine(object):
         if not plugin.name:
             raise NebError("No name for plugin %s" % plugin)
 
+        # so commands are looked up without reflection
+        compile_commands(plugin)
         self.plugin_cls[plugin.name] = plugin
 
     def parse_membership(self, event):
@@ -85,214 +248,315 @@ class Engine(object):
                 if cmd == "help":
                     if len(segments) == 2 and segments[1] in self.plugins:
                         # return help on a plugin
-                        self.matrix.send_message(
-                            room,
-                            self.plugins[segments[1]].__doc__,
-                            msgtype="m.notice"
-                        )
+                        text = self.plugins[segments[1]].__doc__
                     else:
                         # return generic help
-                        self.matrix.send_message(room, self._help(), msgtype="m.notice")
+                        text = self._help()
+                    # after the replies to earlier commands in the room
+                    self.executor.execute(
+                        "help", room, self.outbox.send_message, room, text
+                    )
                 elif cmd in self.plugins:
-                    plugin = self.plugins[cmd]
-                    responses = None
-
-                    try:
-                        responses = plugin.run(
-                            event,
-                            unicode(" ".join(body.split()[1:]).encode("utf8"))
-                        )
-                    except CommandNotFoundError as e:
-                        self.matrix.send_message(
-                            room,
-                            str(e),
-                            msgtype="m.notice"
-                        )
-                    except MatrixRequestError as ex:
-                        self.matrix.send_message(
-                            room,
-                            "Problem making request: (%s) %s" % (ex.code, ex.content),
-                            msgtype="m.notice"
-                        )
-
-                    if responses:
-                        log.debug("[Plugin-%s] Response => %s", cmd, responses)
-                        if type(responses) == list:
-                            for res in responses:
-                                if type(res) in [str, unicode]:
-                                    self.matrix.send_message(
-                                        room,
-                                        res,
-                                        msgtype="m.notice"
-                                    )
-                                else:
-                                    self.matrix.send_message_event(
-                                        room, "m.room.message", res
-                                    )
-                        elif type(responses) in [str, unicode]:
-                            self.matrix.send_message(
-                                room,
-                                responses,
-                                msgtype="m.notice"
-                            )
-                        else:
-                            self.matrix.send_message_event(
-                                room, "m.room.message", responses
-                            )
+                    # the command replies when it is done, so the sync
+                    # thread never waits on plugin code. Commands in a room
+                    # are run in order.
+                    self.executor.execute(
+                        cmd,
+                        room,
+                        self.run_command,
+                        cmd,
+                        event,
+                        unicode(" ".join(body.split()[1:]).encode("utf8"))
+                    )
             except NebError as ne:
-                self.matrix.send_message(room, ne.as_str(), msgtype="m.notice")
+                self.outbox.send_message(room, ne.as_str())
             except Exception as e:
                 log.exception(e)
-                self.matrix.send_message(
-                    room,
-                    "Fatal error when processing command.",
-                    msgtype="m.notice"
+                self.outbox.send_message(
+                    room, "Fatal error when processing command."
                 )
         else:
-            try:
-                for p in self.plugins:
-                    self.plugins[p].on_msg(event, body)
-            except Exception as e:
-                log.exception(e)
+            for p in self.msg_router.get_plugin_names(event["room_id"], body):
+                try:
+                    self.executor.execute(
+                        p, event["room_id"], self.plugins[p].on_msg, event, body
+                    )
+                except NebError as e:
+                    log.warn("Dropped message for plugin %s: %s", p, e.as_str())
+
+    def run_command(self, plugin_name, event, arg_str):
+        """Run a plugin command and send its responses to the room.
+
+        Args:
+            plugin_name(str): The plugin to run the command with.
+            event(dict): The m.room.message event with the command.
+            arg_str(unicode): The command, without the plugin name.
+        """
+        room = event["room_id"]
+        try:
+            responses = self.plugins[plugin_name].run(event, arg_str)
+        except CommandNotFoundError as e:
+            self.outbox.send_message(room, str(e))
+            return
+        except MatrixRequestError as ex:
+            self.outbox.send_message(
+                room,
+                "Problem making request: (%s) %s" % (ex.code, ex.content)
+            )
+            return
+        except NebError as ne:
+            self.outbox.send_message(room, ne.as_str())
+            return
+        except Exception as e:
+            log.exception(e)
+            self.outbox.send_message(
+                room, "Fatal error when processing command."
+            )
+            return
+
+        if responses:
+            log.debug("[Plugin-%s] Response => %s", plugin_name, responses)
+            if type(responses) == list:
+                for res in responses:
+                    if type(res) in [str, unicode]:
+                        self.outbox.send_message(room, res)
+                    else:
+                        self.outbox.send_content(room, res)
+            elif type(responses) in [str, unicode]:
+                self.outbox.send_message(room, responses)
+            else:
+                self.outbox.send_content(room, responses)
 
     def event_proc(self, event):
         etype = event["type"]
+        EVENTS.labels(etype).inc()
+        if "state_key" in event:
+            self.rooms.update(event)
+
         switch = {
             "m.room.member": self.parse_membership,
             "m.room.message": self.parse_msg
         }
-        try:
-            switch[etype](event)
-        except KeyError:
+        plugin_names = self.event_handlers.get(etype, [])
+        if etype in switch:
             try:
-                for p in self.plugins:
-                    self.plugins[p].on_event(event, etype)
+                switch[etype](event)
+            except Exception as e:
+                log.error("Couldn't process event: %s", e)
+        elif self.all_event_plugins:
+            plugin_names = plugin_names + self.all_event_plugins
+
+        # one plugin failing mustn't stop the others getting the event
+        for p in plugin_names:
+            try:
+                self.plugins[p].on_event(event, etype)
             except Exception as e:
                 log.exception(e)
-        except Exception as e:
-            log.error("Couldn't process event: %s", e)
 
     def event_loop(self):
         while True:
-            j = self.matrix.sync(timeout_ms=30000, since=self.sync_token)
-            self.parse_sync(j)
+            self.sync()
+            if self.checkpoint and self.checkpoint.is_due():
+                self.save_checkpoint()
 
-    def parse_sync(self, sync_result, initial_sync=False):
-        self.sync_token = sync_result["next_batch"]  # for when we start syncing
+    def sync(self, initial_sync=False):
+        """Perform a /sync and process the response.
 
-        # check invited rooms
-        rooms = sync_result["rooms"]["invite"]
-        for room_id in rooms:
-            events = rooms[room_id]["invite_state"]["events"]
-            self.process_events(events, room_id)
-
-        # return early if we're performing an initial sync (ie: don't parse joined rooms, just drop the state)
-        if initial_sync:
-            return
-
-        # check joined rooms
-        rooms = sync_result["rooms"]["join"]
-        for room_id in rooms:
-            events = rooms[room_id]["timeline"]["events"]
-            self.process_events(events, room_id)
-
-    def process_events(self, events, room_id):
-        for event in events:
-            event["room_id"] = room_id
-            self.event_proc(event)
-
-
-class RoomContextStore(object):
-    """Stores state events for rooms."""
-
-    def __init__(self, event_types, content_only=True):
-        """Init the store.
-
-        Args:
-            event_types(list<str>): The state event types to store.
-            content_only(bool): True to only store the content for state events.
+        Returns:
+            dict: The /sync response. If the response is being streamed the
+            rooms in this will be empty, as each room is processed and then
+            discarded as soon as it has been parsed.
         """
-        self.state = {}
-        self.types = event_types
-        self.content_only = content_only
-
-    def get_content(self, room_id, event_type, key=""):
-        if self.content_only:
-            return self.state[room_id][(event_type, key)]
-        else:
-            return self.state[room_id][(event_type, key)]["content"]
-
-    def get_room_ids(self):
-        return self.state.keys()
-
-    def update(self, event):
+        start = time.time()
+        self.sync_events = 0
         try:
-            room_id = event["room_id"]
-            etype = event["type"]
-            if etype in self.types:
-                if room_id not in self.state:
-                    self.state[room_id] = {}
-                key = (etype, event["state_key"])
-
-                s = event
-                if self.content_only:
-                    s = event["content"]
-
-                self.state[room_id][key] = s
-        except KeyError:
-            pass
-
-    def init_from_sync(self, sync):
-        for room_id in sync["rooms"]["join"]:
-            # see if we know anything about these rooms
-            room = sync["rooms"]["join"][room_id]
-
-            self.state[room_id] = {}
+            return self._sync(initial_sync)
+        finally:
+            SYNC_SECONDS.observe(time.time() - start)
+            SYNC_EVENTS.observe(self.sync_events)
+
+    def _sync(self, initial_sync):
+        if self.config.sync.get("stream"):
+            if syncstream.is_available():
+                return self._stream_sync(initial_sync)
+            log.warn("Can't stream /sync responses: ijson isn't installed.")
+
+        sync = self.matrix.sync(
+            timeout_ms=self.config.sync.get(
+                "timeout_ms", Engine.SYNC_TIMEOUT_MS
+            ),
+            since=self.sync_token,
+            filter=self.sync_filter
+        )
+        self.parse_sync(sync, initial_sync)
+        return sync
+
+    def _stream_sync(self, initial_sync):
+        timeout_ms = self.config.sync.get("timeout_ms", Engine.SYNC_TIMEOUT_MS)
+        params = {
+            "timeout": timeout_ms,
+            "access_token": self.config.token
+        }
+        if self.sync_token:
+            params["since"] = self.sync_token
+        if self.sync_filter:
+            params["filter"] = self.sync_filter
+
+        res = self.http.get(
+            self.config.base_url + "/_matrix/client/r0/sync",
+            params=params,
+            stream=True,
+            # leave plenty of time for the long-poll to return
+            timeout=(HttpClient.TIMEOUT_S, timeout_ms / 1000.0 + 30)
+        )
+        if res.status_code != 200:
+            raise MatrixRequestError(code=res.status_code, content=res.text)
 
-            try:
-                for state in room["state"]["events"]:
-                    if state["type"] in self.types:
-                        key = (state["type"], state["state_key"])
+        sync = {
+            "next_batch": None,
+            "rooms": {"join": {}, "invite": {}, "leave": {}}
+        }
+        try:
+            res.raw.decode_content = True
+            for section, room_id, room in syncstream.iter_sync(res.raw):
+                if section == "next_batch":
+                    sync["next_batch"] = room
+                elif section == "invite":
+                    self.parse_invited_room(room_id, room)
+                elif section == "join":
+                    self.parse_joined_room(room_id, room, initial_sync)
+        finally:
+            SYNC_BYTES.observe(res.raw.tell())
+            res.close()
+
+        # only move on once every room in the response has been processed
+        self.sync_token = sync["next_batch"] or self.sync_token
+        return sync
+
+    def build_sync_filter(self):
+        """Return a /sync filter for only the events which NEB acts on.
+
+        Presence, typing, receipts and account data are never used, and
+        state/timeline events are restricted to the types the engine handles
+        and the types the plugins say they consume.
+        """
+        event_types = set(self.rooms.types) | set(self.event_handlers)
+        all_types = len(self.all_event_plugins) > 0
+
+        nothing = {"types": []}
+        sync_filter = {
+            "presence": nothing,
+            "account_data": nothing,
+            "room": {
+                "ephemeral": nothing,
+                "account_data": nothing,
+                "state": {
+                    "lazy_load_members": True
+                },
+                "timeline": {
+                    "limit": self.config.sync.get(
+                        "timeline_limit", Engine.TIMELINE_LIMIT
+                    )
+                }
+            }
+        }
+        if not all_types:
+            sync_filter["room"]["state"]["types"] = sorted(event_types)
+            sync_filter["room"]["timeline"]["types"] = sorted(
+                event_types | set(["m.room.message", "m.room.member"])
+            )
+        return sync_filter
 
-                        s = state
-                        if self.content_only:
-                            s = state["content"]
+    def _upload_sync_filter(self, sync_filter):
+        """Upload the filter, returning the filter ID to pass to /sync.
 
-                        self.state[room_id][key] = s
-            except KeyError:
-                pass
+        If the homeserver won't store the filter, the filter is returned as
+        JSON so it can be sent with each /sync instead.
+        """
+        try:
+            res = self.matrix._send(
+                "POST",
+                "/user/%s/filter" % urllib.quote(self.config.user_id),
+                sync_filter,
+                api_path="/_matrix/client/r0"
+            )
+            log.debug("Uploaded sync filter %s: %s",
+                      res["filter_id"], sync_filter)
+            return res["filter_id"]
+        except (MatrixRequestError, KeyError) as e:
+            log.warn("Failed to upload sync filter: %s", e)
+            return json.dumps(sync_filter)
+
+    def save_checkpoint(self):
+        """Save the sync token and plugin state, if checkpoints are enabled.
+
+        The checkpoint is skipped if there are events still being processed,
+        as the plugin state wouldn't be up to date with the sync token.
+        """
+        if not self.checkpoint:
+            return
+        if self.dispatcher and not self.dispatcher.is_idle():
+            log.debug("Skipping checkpoint: events are being processed.")
+            return
 
-        log.debug(pprint.pformat(self.state))
+        plugin_state = {}
+        for plugin_name in self.plugins:
+            state = self.plugins[plugin_name].get_checkpoint()
+            if state is not None:
+                plugin_state[plugin_name] = state
+        try:
+            self.checkpoint.save(
+                self.sync_token, self.rooms.snapshot(), plugin_state
+            )
+        except (IOError, OSError) as e:
+            log.error("Failed to save checkpoint: %s", e)
 
+    def parse_sync(self, sync_result, initial_sync=False):
+        self.sync_token = sync_result["next_batch"]  # for when we start syncing
 
-class KeyValueStore(object):
-    """A persistent JSON store."""
+        # check invited rooms
+        rooms = sync_result["rooms"]["invite"]
+        for room_id in rooms:
+            self.parse_invited_room(room_id, rooms[room_id])
 
-    def __init__(self, config_loc, version="1"):
-        self.config = {
-            "version": version
-        }
-        self.config_loc = config_loc
-        self._load()
+        # check joined rooms
+        rooms = sync_result["rooms"]["join"]
+        for room_id in rooms:
+            self.parse_joined_room(room_id, rooms[room_id], initial_sync)
 
-    def _load(self):
-        try:
-            with open(self.config_loc, 'r') as f:
-                self.config = json.loads(f.read())
-        except:
-            self._save()
+    def parse_invited_room(self, room_id, room):
+        events = room["invite_state"]["events"]
+        self.process_events(events, room_id)
 
-    def _save(self):
-        with open(self.config_loc, 'w') as f:
-            f.write(json.dumps(self.config, indent=4))
+    def parse_joined_room(self, room_id, room, initial_sync=False):
+        # if we're performing an initial sync, just store the state and drop
+        # the timeline.
+        if initial_sync:
+            self.sync_events += (
+                len(room.get("state", {}).get("events", [])) +
+                len(room.get("timeline", {}).get("events", []))
+            )
+            self.rooms.init_room(room_id, room)
+            for plugin_name in self.plugins:
+                try:
+                    self.plugins[plugin_name].on_sync_room(room_id, room)
+                except Exception as e:
+                    log.exception(e)
+            return
 
-    def has(self, key):
-        return key in self.config
+        # state which changed before the timeline starts, e.g. if there
+        # was a gap since the last sync.
+        events = room.get("state", {}).get("events", [])
+        self.process_events(events, room_id)
 
-    def set(self, key, value, save=True):
-        self.config[key] = value
-        if save:
-            self._save()
+        events = room["timeline"]["events"]
+        self.process_events(events, room_id)
 
-    def get(self, key):
-        return self.config[key]
+    def process_events(self, events, room_id):
+        self.sync_events += len(events)
+        for event in events:
+            event["room_id"] = room_id
+            if self.dispatcher:
+                self.dispatcher.dispatch(room_id, event)
+            else:
+                self.event_proc(event)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""Runs plugin commands and hooks on a shared pool of worker threads.
+
+Each plugin gets its own lane with a cap on how many of its tasks can run at
+once and how many can be waiting to run, so a plugin which is stuck talking to
+a slow remote service only ties up its own share of the workers. Tasks can be
+given a key, such as a room ID: tasks with the same key are run one at a time,
+in the order they were submitted, whichever plugins they are for.
+"""
+from collections import deque
+from neb import NebError
+from neb import metrics
+import threading
+
+import logging as log
+
+PLUGIN_QUEUE_DEPTH = metrics.gauge(
+    "neb_plugin_queue_depth",
+    "The number of tasks waiting to run for each plugin.",
+    ["plugin"]
+)
+
+
+class PluginBusyError(NebError):
+    """The plugin already has too many tasks waiting to run."""
+
+    def __init__(self, plugin_name):
+        NebError.__init__(
+            self, 503, "%s is busy, try again later." % plugin_name
+        )
+
+
+class Task(object):
+    """A function call which is run by a worker."""
+
+    def __init__(self, fn, args, key=None):
+        self.fn = fn
+        self.args = args
+        self.key = key  # tasks with the same key are run one at a time
+
+    def run(self):
+        try:
+            self.fn(*self.args)
+        except Exception as e:
+            log.exception(e)
+
+
+class Lane(object):
+    """The tasks for a single plugin."""
+
+    def __init__(self, max_concurrency, max_queue):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.running = 0
+        self.pending = deque()
+
+
+class PluginExecutor(object):
+    """A bounded worker pool with per-plugin concurrency limits."""
+
+    WORKERS = 16
+    MAX_CONCURRENCY = 1
+    MAX_QUEUE = 20
+
+    def __init__(self, config=None):
+        """Start the executor.
+
+        Args:
+            config(dict): Optional. Keys are 'workers' and the defaults for
+                each plugin: 'max_concurrency' and 'max_queue'. 'plugins' can
+                map plugin names to overrides for these. Plugins run one task
+                at a time unless they are known to be thread-safe and are
+                given a higher 'max_concurrency'.
+        """
+        self.config = config or {}
+        self.lanes = {
+        #    plugin_name : Lane
+        }
+        self.lane_order = deque()  # plugin names, rotated to share workers
+        self.keys = {
+        #    key : deque of the Tasks with this key, the running one first
+        }
+        self.cond = threading.Condition()
+
+        workers = self.config.get("workers", PluginExecutor.WORKERS)
+        for i in range(workers):
+            t = threading.Thread(
+                target=self._work, name="PluginExecutor-%s" % i
+            )
+            t.daemon = True
+            t.start()
+
+    def execute(self, plugin_name, key, fn, *args):
+        """Run a function for a plugin without waiting for it to return.
+
+        Args:
+            plugin_name(str): The plugin to run the function for.
+            key(str): Functions with the same key, such as a room ID, are
+                run one at a time in the order they were submitted. None to
+                run whenever the plugin has a free slot.
+            fn: The function to run.
+            *args: The arguments to call fn with.
+        Raises:
+            PluginBusyError: If the plugin's queue is full.
+        """
+        lane = self._get_lane(plugin_name)
+        with self.cond:
+            if len(lane.pending) >= lane.max_queue:
+                log.warn("Rejecting task for %s: %s tasks queued.",
+                         plugin_name, len(lane.pending))
+                raise PluginBusyError(plugin_name)
+            task = Task(fn, args, key)
+            lane.pending.append(task)
+            if key is not None:
+                self.keys.setdefault(key, deque()).append(task)
+            self.cond.notify()
+
+    def queue_depths(self):
+        """Return a dict of plugin name to the number of waiting tasks."""
+        with self.cond:
+            return dict(
+                (name, len(self.lanes[name].pending)) for name in self.lanes
+            )
+
+    def _get_lane(self, plugin_name):
+        with self.cond:
+            if plugin_name not in self.lanes:
+                opts = dict(self.config)
+                opts.update(self.config.get("plugins", {}).get(plugin_name, {}))
+                self.lanes[plugin_name] = Lane(
+                    opts.get("max_concurrency", PluginExecutor.MAX_CONCURRENCY),
+                    opts.get("max_queue", PluginExecutor.MAX_QUEUE)
+                )
+                self.lane_order.append(plugin_name)
+                lane = self.lanes[plugin_name]
+                PLUGIN_QUEUE_DEPTH.labels(plugin_name).set_function(
+                    lambda: len(lane.pending)
+                )
+            return self.lanes[plugin_name]
+
+    def _next_task(self):
+        # must be called with self.cond held
+        for i in range(len(self.lane_order)):
+            lane = self.lanes[self.lane_order[0]]
+            self.lane_order.rotate(-1)
+            if lane.running >= lane.max_concurrency:
+                continue
+            for j, task in enumerate(lane.pending):
+                # a keyed task waits for the earlier tasks with its key
+                if task.key is None or self.keys[task.key][0] is task:
+                    del lane.pending[j]
+                    lane.running += 1
+                    return lane, task
+        return None, None
+
+    def _finish(self, lane, task):
+        # must be called with self.cond held
+        lane.running -= 1
+        if task.key is not None:
+            tasks = self.keys[task.key]
+            tasks.popleft()
+            if not tasks:
+                del self.keys[task.key]
+        # a task which was held back by the cap or by its key can now run.
+        self.cond.notify_all()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                lane, task = self._next_task()
+                while not task:
+                    self.cond.wait()
+                    lane, task = self._next_task()
+
+            task.run()
+
+            with self.cond:
+                self._finish(lane, task)
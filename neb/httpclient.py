@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""A shared HTTP client for plugins which talk to remote REST APIs.
+
+Connections are kept alive in a pool per host, so repeated calls to the same
+service don't pay for a new TCP and TLS handshake each time.
+"""
+from neb import metrics
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import requests
+import threading
+import time
+import urlparse
+
+import logging as log
+
+REQUEST_SECONDS = metrics.histogram(
+    "neb_http_request_duration_seconds",
+    "The time outbound HTTP requests took, including retries.",
+    ["host"]
+)
+REQUEST_ERRORS = metrics.counter(
+    "neb_http_request_errors_total",
+    "Outbound HTTP requests which failed or got a 5xx.",
+    ["host"]
+)
+
+
+class HostStats(object):
+    """Request counts and latency for a single host."""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.total_latency_s = 0.0
+        self.max_latency_s = 0.0
+
+    def record(self, latency_s, failed):
+        self.requests += 1
+        if failed:
+            self.errors += 1
+        self.total_latency_s += latency_s
+        self.max_latency_s = max(self.max_latency_s, latency_s)
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "total_latency_s": self.total_latency_s,
+            "max_latency_s": self.max_latency_s
+        }
+
+
+class HttpClient(object):
+    """Makes HTTP requests over pooled keep-alive connections.
+
+    Idempotent requests are retried with exponential backoff if the connection
+    fails or the server responds with a 5xx; POSTs are never retried.
+    """
+
+    POOL_CONNECTIONS = 10  # the number of hosts to keep pools for
+    POOL_MAXSIZE = 10  # the number of connections to keep per host
+    TIMEOUT_S = 10
+    RETRIES = 3
+    BACKOFF_FACTOR = 0.5
+
+    def __init__(self, config=None):
+        """Create the client.
+
+        Args:
+            config(dict): Optional. Keys are 'pool_connections',
+                'pool_maxsize', 'timeout_s', 'retries' and 'backoff_factor'.
+        """
+        config = config or {}
+        self.timeout_s = config.get("timeout_s", HttpClient.TIMEOUT_S)
+        retry = Retry(
+            total=config.get("retries", HttpClient.RETRIES),
+            backoff_factor=config.get(
+                "backoff_factor", HttpClient.BACKOFF_FACTOR
+            ),
+            status_forcelist=[500, 502, 503, 504],
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(
+            pool_connections=config.get(
+                "pool_connections", HttpClient.POOL_CONNECTIONS
+            ),
+            pool_maxsize=config.get("pool_maxsize", HttpClient.POOL_MAXSIZE),
+            max_retries=retry
+        )
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.stats = {
+        #    host : HostStats
+        }
+        self.stats_lock = threading.Lock()
+
+    def request(self, method, url, **kwargs):
+        """Make a request. Takes the same arguments as requests.request."""
+        kwargs.setdefault("timeout", self.timeout_s)
+        host = urlparse.urlparse(url).netloc
+        start = time.time()
+        try:
+            res = self.session.request(method, url, **kwargs)
+        except requests.RequestException as e:
+            log.warn("%s %s failed: %s", method, url, e)
+            self._record(host, time.time() - start, True)
+            raise
+        self._record(host, time.time() - start, res.status_code >= 500)
+        return res
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def get_stats(self):
+        """Return a dict of host to a dict of request counts and latency."""
+        with self.stats_lock:
+            return dict(
+                (host, self.stats[host].as_dict()) for host in self.stats
+            )
+
+    def _record(self, host, latency_s, failed):
+        REQUEST_SECONDS.labels(host).observe(latency_s)
+        if failed:
+            REQUEST_ERRORS.labels(host).inc()
+        with self.stats_lock:
+            if host not in self.stats:
+                self.stats[host] = HostStats()
+            self.stats[host].record(latency_s, failed)
@@ -9,13 +9,45 @@ class MatrixConfig(object):
     TOK = "token"
     ADM = "admins"
     CIS = "case_insensitive"
+    DSP = "dispatch"
+    EXE = "executor"
+    HTP = "http"
+    OUT = "outbox"
+    CHK = "checkpoint"
+    SYN = "sync"
+    WHK = "webhook"
+    SPL = "spool"
 
-    def __init__(self, hs_url, user_id, access_token, admins, case_insensitive):
+    def __init__(self, hs_url, user_id, access_token, admins, case_insensitive,
+                 dispatch=None, executor=None, http=None, outbox=None,
+                 checkpoint=None, sync=None, webhook=None, spool=None):
         self.user_id = user_id
         self.token = access_token
         self.base_url = hs_url
         self.admins = admins
         self.case_insensitive = case_insensitive
+        # { concurrent: bool, workers: int }
+        self.dispatch = dispatch or {}
+        # { workers: int, max_concurrency: int, max_queue: int,
+        #   plugins: { plugin_name: { ...overrides } } }
+        self.executor = executor or {}
+        # { pool_connections: int, pool_maxsize: int, timeout_s: int,
+        #   retries: int, backoff_factor: float }
+        self.http = http or {}
+        # { workers: int, rate_per_s: float, burst: int, max_coalesce: int }
+        self.outbox = outbox or {}
+        # { path: str, interval_s: int }
+        self.checkpoint = checkpoint or {}
+        # { filter: bool, timeline_limit: int, timeout_ms: int }
+        self.sync = sync or {}
+        # { host: str, port: int,  (the address to listen on)
+        #   server: "auto"|"waitress"|"flask", threads: int,
+        #   connection_limit: int, keepalive_s: int, max_body_bytes: int,
+        #   dedup_max_size: int, dedup_ttl_s: int,  (see NebHookServer)
+        #   workers: int, max_queue: int }  (see WebhookPipeline)
+        self.webhook = webhook or {}
+        # { path: str, segment_bytes: int }
+        self.spool = spool or {}
 
     @classmethod
     def to_file(cls, config, f):
@@ -24,7 +56,15 @@ class MatrixConfig(object):
             MatrixConfig.TOK: config.token,
             MatrixConfig.USR: config.user_id,
             MatrixConfig.ADM: config.admins,
-            MatrixConfig.CIS: config.case_insensitive
+            MatrixConfig.CIS: config.case_insensitive,
+            MatrixConfig.DSP: config.dispatch,
+            MatrixConfig.EXE: config.executor,
+            MatrixConfig.HTP: config.http,
+            MatrixConfig.OUT: config.outbox,
+            MatrixConfig.CHK: config.checkpoint,
+            MatrixConfig.SYN: config.sync,
+            MatrixConfig.WHK: config.webhook,
+            MatrixConfig.SPL: config.spool
         }, indent=4))
 
     @classmethod
@@ -42,5 +82,13 @@ class MatrixConfig(object):
             user_id=j[MatrixConfig.USR],
             access_token=j[MatrixConfig.TOK],
             admins=j[MatrixConfig.ADM],
-            case_insensitive=j[MatrixConfig.CIS] if MatrixConfig.CIS in j else False
+            case_insensitive=j[MatrixConfig.CIS] if MatrixConfig.CIS in j else False,
+            dispatch=j.get(MatrixConfig.DSP),
+            executor=j.get(MatrixConfig.EXE),
+            http=j.get(MatrixConfig.HTP),
+            outbox=j.get(MatrixConfig.OUT),
+            checkpoint=j.get(MatrixConfig.CHK),
+            sync=j.get(MatrixConfig.SYN),
+            webhook=j.get(MatrixConfig.WHK),
+            spool=j.get(MatrixConfig.SPL)
         )
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+"""Counters, gauges and histograms exported in the Prometheus text format.
+
+Metrics are created once, usually at module level, and then updated from the
+code being measured:
+
+    REQUESTS = metrics.counter("neb_requests_total", "Requests.", ["host"])
+    REQUESTS.labels("example.com").inc()
+
+The NebHookServer serves the registry on /metrics.
+"""
+import threading
+import time
+
+import logging as log
+
+# in seconds, from a fast local call up to a slow remote service
+DEFAULT_BUCKETS = [
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60
+]
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return (
+        unicode(value).replace("\\", "\\\\").replace("\n", "\\n")
+        .replace("\"", "\\\"")
+    )
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join(
+        "%s=\"%s\"" % (name, _escape(value))
+        for (name, value) in zip(names, values)
+    )
+
+
+class Timer(object):
+    """Observes how long a block took, for use with 'with'."""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start)
+
+
+class CounterValue(object):
+    """A counter with a single set of label values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name):
+        return [(name, [], [], self.value)]
+
+
+class GaugeValue(object):
+    """A gauge with a single set of label values."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+        self.fn = None
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set_function(self, fn):
+        """Read the value from fn whenever the gauge is exported."""
+        self.fn = fn
+
+    def samples(self, name):
+        value = self.value
+        if self.fn:
+            value = self.fn()
+        return [(name, [], [], value)]
+
+
+class HistogramValue(object):
+    """A histogram with a single set of label values."""
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name):
+        with self.lock:
+            counts = list(self.counts)
+            total_sum = self.sum
+            count = self.count
+        samples = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            samples.append((
+                name + "_bucket", ["le"], [_format_value(bound)], cumulative
+            ))
+        samples.append((name + "_bucket", ["le"], ["+Inf"], count))
+        samples.append((name + "_sum", [], [], total_sum))
+        samples.append((name + "_count", [], [], count))
+        return samples
+
+
+class Metric(object):
+    """A named metric with a value per combination of label values.
+
+    Metrics without labels can be updated directly, e.g. gauge.set(1).
+    """
+
+    def __init__(self, metric_type, name, description, label_names,
+                 value_factory):
+        self.type = metric_type
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names or [])
+        self.value_factory = value_factory
+        self.values = {
+        #    tuple of label values : CounterValue/GaugeValue/HistogramValue
+        }
+        self.lock = threading.Lock()
+
+    def labels(self, *label_values):
+        """Return the value to update for some label values.
+
+        Args:
+            *label_values: One value for each of the metric's label names.
+        """
+        if len(label_values) != len(self.label_names):
+            raise ValueError("%s expects labels %s, got %s" %
+                             (self.name, self.label_names, label_values))
+        with self.lock:
+            if label_values not in self.values:
+                self.values[label_values] = self.value_factory()
+            return self.values[label_values]
+
+    def remove(self, *label_values):
+        """Stop exporting the value for some label values."""
+        with self.lock:
+            self.values.pop(label_values, None)
+
+    def __getattr__(self, attr):
+        # inc(), set(), observe() etc on a metric without labels
+        if attr.startswith("__") or self.__dict__.get("label_names", True):
+            raise AttributeError(attr)
+        return getattr(self.labels(), attr)
+
+    def render(self):
+        """Return the metric in the Prometheus text format."""
+        lines = [
+            "# HELP %s %s" % (
+                self.name,
+                self.description.replace("\\", "\\\\").replace("\n", "\\n")
+            ),
+            "# TYPE %s %s" % (self.name, self.type)
+        ]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            try:
+                samples = value.samples(self.name)
+            except Exception as e:
+                log.error("Failed to read %s%s: %s", self.name,
+                          _format_labels(self.label_names, label_values), e)
+                continue
+            for (name, extra_names, extra_values, sample) in samples:
+                lines.append("%s%s %s" % (
+                    name,
+                    _format_labels(
+                        self.label_names + tuple(extra_names),
+                        label_values + tuple(extra_values)
+                    ),
+                    _format_value(sample)
+                ))
+        return "\n".join(lines)
+
+
+class Registry(object):
+    """The set of metrics to export."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = {
+        #    name : Metric
+        }
+        self.lock = threading.Lock()
+
+    def counter(self, name, description, labels=None):
+        """Return a counter, creating it if needed.
+
+        Args:
+            name(str): The metric name. Should end in _total.
+            description(str): What the metric counts.
+            labels(list<str>): Optional. The label names.
+        Returns:
+            Metric: The counter.
+        """
+        return self._get(
+            "counter", name, description, labels, CounterValue
+        )
+
+    def gauge(self, name, description, labels=None):
+        """Return a gauge, creating it if needed."""
+        return self._get("gauge", name, description, labels, GaugeValue)
+
+    def histogram(self, name, description, labels=None,
+                  buckets=DEFAULT_BUCKETS):
+        """Return a histogram, creating it if needed.
+
+        Args:
+            name(str): The metric name.
+            description(str): What the metric measures.
+            labels(list<str>): Optional. The label names.
+            buckets(list<float>): The upper bounds of the buckets, ascending.
+        Returns:
+            Metric: The histogram.
+        """
+        buckets = sorted(buckets)
+        return self._get(
+            "histogram", name, description, labels,
+            lambda: HistogramValue(buckets)
+        )
+
+    def render(self):
+        """Return every metric in the Prometheus text format."""
+        with self.lock:
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+    def _get(self, metric_type, name, description, labels, value_factory):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric:
+                if (metric.type != metric_type or
+                        metric.label_names != tuple(labels or [])):
+                    raise ValueError("Metric %s already exists as a %s %s" %
+                                     (name, metric.type, metric.label_names))
+                return metric
+            metric = Metric(
+                metric_type, name, description, labels, value_factory
+            )
+            self.metrics[name] = metric
+            return metric
+
+
+# the registry which NEB's own metrics are in
+registry = Registry()
+
+
+def counter(name, description, labels=None):
+    """Return a counter in the default registry."""
+    return registry.counter(name, description, labels)
+
+
+def gauge(name, description, labels=None):
+    """Return a gauge in the default registry."""
+    return registry.gauge(name, description, labels)
+
+
+def histogram(name, description, labels=None, buckets=DEFAULT_BUCKETS):
+    """Return a histogram in the default registry."""
+    return registry.histogram(name, description, labels, buckets)
+
+
+# shared by everything which queues work, labelled with the queue's name
+QUEUE_DEPTH = gauge(
+    "neb_queue_depth", "Items waiting to be processed.", ["queue"]
+)
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""Queues outgoing messages and sends them to rooms at a bounded rate.
+
+Bursts of messages to the same room are merged into a single message, and
+messages which fail to send are retried with the same transaction ID until the
+homeserver accepts them, so they are delivered at least once but not shown
+twice. If a Spool is given, queued messages also survive a restart.
+
+Messages are sent by a pool of workers, at most one message per room at a
+time, so a room which is slow or failing only holds up its own messages.
+"""
+from collections import deque
+from matrix_client.api import MatrixRequestError
+from neb import metrics
+import cgi
+import json
+import math
+import threading
+import time
+
+import logging as log
+
+SEND_SECONDS = metrics.histogram(
+    "neb_matrix_send_duration_seconds",
+    "The time the homeserver took to accept a message."
+)
+SEND_FAILURES = metrics.counter(
+    "neb_matrix_send_failures_total",
+    "Messages the homeserver didn't accept, by reason: 'rate_limited' and "
+    "'error' are retried, 'rejected' are dropped.",
+    ["reason"]
+)
+QUEUED_SECONDS = metrics.histogram(
+    "neb_outbox_queued_seconds",
+    "The time from a message being queued to the homeserver accepting it."
+)
+
+
+class OutgoingMessage(object):
+    """An m.room.message waiting to be sent."""
+
+    def __init__(self, room_id, content):
+        self.room_id = room_id
+        self.content = content
+        self.txn_id = None  # assigned on the first attempt to send it
+        self.spool_ids = []  # the spool entries this message delivers
+        self.queued_at = time.time()
+
+
+class RoomOutbox(object):
+    """The messages waiting to be sent to a single room."""
+
+    def __init__(self, burst):
+        self.messages = deque()
+        self.sending = False  # True if a message is being sent to the room
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.not_before = 0  # the time this room can next be sent to
+        self.backoff_s = 0
+
+    def refill(self, now, rate_per_s, burst):
+        self.tokens = min(
+            burst, self.tokens + (now - self.last_refill) * rate_per_s
+        )
+        self.last_refill = now
+
+
+def percentiles(samples, ps):
+    """Return the nearest-rank percentiles of some samples.
+
+    Args:
+        samples(list<float>): The samples.
+        ps(list<int>): The percentiles to return, e.g. [50, 99].
+    Returns:
+        dict: 'p<percentile>' to its value, or an empty dict if there are no
+        samples.
+    """
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+    return dict(
+        ("p%s" % p,
+         ordered[max(0, int(math.ceil(p / 100.0 * len(ordered))) - 1)])
+        for p in ps
+    )
+
+
+class Outbox(object):
+    """A rate limited queue of messages to send to rooms."""
+
+    WORKERS = 4  # the number of rooms which can be sent to at once
+    RATE_PER_S = 1.0  # the sustained number of messages per room per second
+    BURST = 5  # the number of messages a room can be sent in a burst
+    MAX_COALESCE = 20  # the max number of messages to merge into one
+    MAX_COALESCE_LEN = 16000  # the max length of a merged message body
+
+    # for messages which failed to send
+    INITIAL_BACKOFF_S = 5
+    BACKOFF_INCREMENT_S = 5
+    MAX_BACKOFF_S = 60 * 5
+
+    LATENCY_SAMPLES = 100  # the number of send latencies kept per room
+    LATENCY_PERCENTILES = [50, 90, 99]
+
+    COALESCE_KEYS = set(["body", "msgtype", "format", "formatted_body"])
+    HTML_FORMAT = "org.matrix.custom.html"
+
+    SPOOL_KIND = "message"
+
+    def __init__(self, matrix_api, config=None, spool=None):
+        """Start sending messages.
+
+        Args:
+            matrix_api(MatrixHttpApi): The API to send messages with.
+            config(dict): Optional. Keys are 'workers', 'rate_per_s',
+                'burst' and 'max_coalesce'.
+            spool(Spool): Optional. Where to keep messages until they are
+                sent.
+        """
+        config = config or {}
+        self.matrix = matrix_api
+        self.spool = spool
+        self.rate_per_s = config.get("rate_per_s", Outbox.RATE_PER_S)
+        self.burst = config.get("burst", Outbox.BURST)
+        self.max_coalesce = config.get("max_coalesce", Outbox.MAX_COALESCE)
+
+        self.rooms = {
+        #    room_id : RoomOutbox
+        }
+        self.latencies = {
+        #    room_id : deque of the seconds recent messages waited to be sent
+        }
+        self.paused_until = 0  # set when the homeserver rate limits us
+        self.cond = threading.Condition()
+        self.txn_counter = 0
+        self.txn_prefix = "neb%s." % int(time.time() * 1000)
+
+        for i in range(config.get("workers", Outbox.WORKERS)):
+            t = threading.Thread(target=self._run, name="Outbox-%s" % i)
+            t.daemon = True
+            t.start()
+
+    def send_message(self, room_id, text, msgtype="m.notice"):
+        """Queue a plain text message."""
+        self.send_content(room_id, self.matrix.get_text_body(text, msgtype))
+
+    def send_html(self, room_id, html, msgtype="m.notice"):
+        """Queue an HTML message."""
+        self.send_content(room_id, self.matrix.get_html_body(html, msgtype))
+
+    def send_content(self, room_id, content, spool_id=None):
+        """Queue an m.room.message.
+
+        Args:
+            room_id(str): The room to send the message to.
+            content(dict): The m.room.message content.
+            spool_id(int): Optional. The spool entry for the message, if it
+                is being replayed from the spool.
+        """
+        msg = OutgoingMessage(room_id, content)
+        if spool_id:
+            msg.spool_ids.append(spool_id)
+        elif self.spool:
+            # the caller syncs the spool if it needs the message to be durable
+            msg.spool_ids.append(self.spool.put(
+                Outbox.SPOOL_KIND,
+                {"room_id": room_id, "content": content},
+                sync=False
+            ))
+
+        with self.cond:
+            if room_id not in self.rooms:
+                self.rooms[room_id] = RoomOutbox(self.burst)
+            self.rooms[room_id].messages.append(msg)
+            self.cond.notify()
+
+    def queue_depth(self):
+        """Return the number of messages waiting to be sent."""
+        with self.cond:
+            return sum(len(r.messages) for r in self.rooms.values())
+
+    def get_stats(self):
+        """Return the queue depth and the send latency percentiles per room.
+
+        Latencies are the time from a message being queued to the homeserver
+        accepting it.
+        """
+        with self.cond:
+            rooms = dict(
+                (room_id, {
+                    "sent": len(self.latencies[room_id]),
+                    "latency_s": percentiles(
+                        self.latencies[room_id], Outbox.LATENCY_PERCENTILES
+                    )
+                })
+                for room_id in self.latencies
+            )
+            for room_id in self.rooms:
+                rooms.setdefault(room_id, {"sent": 0, "latency_s": {}})
+                rooms[room_id]["queued"] = len(self.rooms[room_id].messages)
+                rooms[room_id]["backoff_s"] = self.rooms[room_id].backoff_s
+            return {
+                "queue_depth": sum(
+                    len(r.messages) for r in self.rooms.values()
+                ),
+                "rooms": rooms
+            }
+
+    def wait_empty(self, timeout=None):
+        """Block until there are no messages waiting to be sent.
+
+        Returns:
+            bool: True if the queue is empty.
+        """
+        end = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while any(r.messages or r.sending for r in self.rooms.values()):
+                remaining = end - time.time() if end is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+            return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                msg, wait_s = self._next_message()
+                while not msg:
+                    self.cond.wait(wait_s)
+                    msg, wait_s = self._next_message()
+
+            self._send(msg)
+
+    def _next_message(self):
+        """Take the next message which can be sent right now.
+
+        Must be called with self.cond held.
+
+        Returns:
+            A tuple of (OutgoingMessage or None, the number of seconds until a
+            message may be ready or None to wait for a new message).
+        """
+        now = time.time()
+        if self.paused_until > now:
+            return None, self.paused_until - now
+
+        wait_s = None
+        for room_id in self.rooms.keys():
+            room = self.rooms[room_id]
+            room.refill(now, self.rate_per_s, self.burst)
+            if room.sending:
+                continue  # keep messages to a room in order
+            if not room.messages:
+                # forget about rooms which are back to their full allowance
+                if room.tokens >= self.burst and not room.backoff_s:
+                    del self.rooms[room_id]
+                continue
+
+            if room.tokens < 1:
+                room.not_before = max(
+                    room.not_before,
+                    now + (1 - room.tokens) / self.rate_per_s
+                )
+
+            if room.not_before > now:
+                ready_in = room.not_before - now
+                if wait_s is None or ready_in < wait_s:
+                    wait_s = ready_in
+                continue
+
+            room.tokens -= 1
+            room.sending = True
+            return self._coalesce(room), None
+        return None, wait_s
+
+    def _coalesce(self, room):
+        """Merge the messages at the head of the room's queue into one."""
+        msg = room.messages.popleft()
+        if msg.txn_id or not self._can_coalesce(msg.content):
+            return msg  # this is a retry, or a message we can't merge
+
+        batch = [msg.content]
+        spool_ids = list(msg.spool_ids)
+        length = len(msg.content["body"])
+        while room.messages and len(batch) < self.max_coalesce:
+            content = room.messages[0].content
+            if (room.messages[0].txn_id or
+                    not self._can_coalesce(content) or
+                    content["msgtype"] != msg.content["msgtype"] or
+                    length + len(content["body"]) > Outbox.MAX_COALESCE_LEN):
+                break
+            batch.append(content)
+            length += len(content["body"])
+            spool_ids.extend(room.messages.popleft().spool_ids)
+
+        if len(batch) == 1:
+            return msg
+
+        content = {
+            "msgtype": msg.content["msgtype"],
+            "body": "\n".join(c["body"] for c in batch)
+        }
+        if any(c.get("format") == Outbox.HTML_FORMAT for c in batch):
+            content["format"] = Outbox.HTML_FORMAT
+            content["formatted_body"] = "<br/>".join(
+                c["formatted_body"] if c.get("format") == Outbox.HTML_FORMAT
+                else cgi.escape(c["body"]).replace("\n", "<br/>")
+                for c in batch
+            )
+        merged = OutgoingMessage(msg.room_id, content)
+        merged.spool_ids = spool_ids
+        merged.queued_at = msg.queued_at  # the oldest message in the batch
+        return merged
+
+    def _can_coalesce(self, content):
+        return (
+            "body" in content and "msgtype" in content and
+            set(content.keys()) <= Outbox.COALESCE_KEYS and
+            (not content.get("format") or
+                content["format"] == Outbox.HTML_FORMAT)
+        )
+
+    def _send(self, msg):
+        if not msg.txn_id:
+            with self.cond:
+                self.txn_counter += 1
+                msg.txn_id = self.txn_prefix + str(self.txn_counter)
+
+        try:
+            with SEND_SECONDS.time():
+                self.matrix.send_message_event(
+                    msg.room_id, "m.room.message", msg.content,
+                    txn_id=msg.txn_id
+                )
+            QUEUED_SECONDS.observe(time.time() - msg.queued_at)
+            with self.cond:
+                room = self.rooms[msg.room_id]
+                room.sending = False
+                room.backoff_s = 0
+                if msg.room_id not in self.latencies:
+                    self.latencies[msg.room_id] = deque(
+                        maxlen=Outbox.LATENCY_SAMPLES
+                    )
+                self.latencies[msg.room_id].append(
+                    time.time() - msg.queued_at
+                )
+                self.cond.notify_all()  # for wait_empty
+            self._ack(msg)
+            return
+        except MatrixRequestError as e:
+            if e.code == 429:
+                SEND_FAILURES.labels("rate_limited").inc()
+                retry_after_ms = 0
+                try:
+                    retry_after_ms = json.loads(e.content)["retry_after_ms"]
+                except (ValueError, KeyError, TypeError):
+                    pass
+                log.warn("Rate limited by the homeserver for %sms",
+                         retry_after_ms)
+                with self.cond:
+                    self.paused_until = max(
+                        self.paused_until,
+                        time.time() + max(retry_after_ms / 1000.0, 1)
+                    )
+                    self._requeue(msg, backoff=False)
+                return
+            elif 400 <= e.code < 500:
+                SEND_FAILURES.labels("rejected").inc()
+                log.error("Matrix ignored message for %s: %s", msg.room_id, e)
+                with self.cond:
+                    self.rooms[msg.room_id].sending = False
+                    self.cond.notify_all()
+                self._ack(msg)
+                return
+            log.warn("Failed to send message to %s: %s", msg.room_id, e)
+        except Exception as e:
+            log.warn("Failed to send message to %s: %s", msg.room_id, e)
+        SEND_FAILURES.labels("error").inc()
+
+        with self.cond:
+            self._requeue(msg, backoff=True)
+
+    def _ack(self, msg):
+        if self.spool:
+            for spool_id in msg.spool_ids:
+                self.spool.ack(spool_id)
+
+    def _requeue(self, msg, backoff):
+        # must be called with self.cond held
+        room = self.rooms[msg.room_id]
+        room.sending = False
+        room.messages.appendleft(msg)
+        if backoff:
+            if room.backoff_s:
+                room.backoff_s = min(
+                    room.backoff_s + Outbox.BACKOFF_INCREMENT_S,
+                    Outbox.MAX_BACKOFF_S
+                )
+            else:
+                room.backoff_s = Outbox.INITIAL_BACKOFF_S
+            room.not_before = time.time() + room.backoff_s
+        self.cond.notify()
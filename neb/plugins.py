@@ -8,12 +8,22 @@
 #   send_message(foo, bar)
 
 from functools import wraps
+from neb import metrics
+from neb.httpclient import HttpClient
+from neb.outbox import Outbox
+from neb.state import RoomContextStore
 import inspect
 import json
 import shlex
 
 import logging as log
 
+COMMAND_SECONDS = metrics.histogram(
+    "neb_command_duration_seconds",
+    "The time plugin commands took to run.",
+    ["plugin", "command"]
+)
+
 
 def admin_only(fn):
     @wraps(fn)
@@ -27,16 +37,79 @@ def admin_only(fn):
     return wrapped
 
 
+def overrides(plugin, method_name):
+    """Return True if the plugin overrides the PluginInterface method."""
+    method = getattr(type(plugin), method_name)
+    return method.im_func is not getattr(PluginInterface, method_name).im_func
+
+
 class CommandNotFoundError(Exception):
     pass
 
 
+class CommandNode(object):
+    """A node in a trie of command words.
+
+    "!foo bar baz" runs cmd_foo_bar_baz, which is found by following the
+    children 'foo', 'bar' then 'baz' from the root.
+    """
+
+    def __init__(self):
+        self.children = {
+        #    word : CommandNode
+        }
+        self.method_name = None  # set if there is a cmd_ method for this node
+        self.num_params = 0  # excluding self
+        self.num_trailing_opt = 0  # "opt_" params at the end, padded with None
+
+
+def compile_commands(cls):
+    """Build the command trie for a Plugin class from its cmd_ methods.
+
+    Args:
+        cls: The Plugin class.
+    Returns:
+        CommandNode: The root of the trie, which is also stored on the class.
+    """
+    root = CommandNode()
+    for name in dir(cls):
+        method = getattr(cls, name)
+        if not name.startswith("cmd_") or not callable(method):
+            continue
+        node = root
+        for word in name[len("cmd_"):].split("_"):
+            if word not in node.children:
+                node.children[word] = CommandNode()
+            node = node.children[word]
+
+        node.method_name = name
+        fn_param_names = inspect.getargspec(method)[0][1:]  # remove self
+        node.num_params = len(fn_param_names)
+        for param in reversed(fn_param_names):
+            if not param.startswith("opt_"):
+                break
+            node.num_trailing_opt += 1
+
+    cls._command_trie = root
+    return root
+
+
 class PluginInterface(object):
 
-    def __init__(self, matrix_api, config, web_hook_server):
+    def __init__(self, matrix_api, config, web_hook_server, http=None,
+                 outbox=None, room_store=None, spool=None):
         self.matrix = matrix_api
         self.config = config
         self.webhook = web_hook_server
+        # for talking to remote REST APIs
+        self.http = http or HttpClient(config.http)
+        # for sending messages to rooms
+        self.outbox = outbox or Outbox(matrix_api, config.outbox)
+        # the room state tracked by the engine: see RoomContextStore.view
+        self.room_store = room_store or RoomContextStore([])
+        # for work which must survive a restart, or None if there is no spool.
+        # Use kinds starting with '<plugin name>.': see on_spool_replay.
+        self.spool = spool
 
     def run(self, event, arg_str):
         """Run the requested command.
@@ -55,7 +128,52 @@ class PluginInterface(object):
         """Received initial sync results.
 
         Args:
-            response(dict): The raw initialSync response.
+            response(dict): The raw initialSync response. If the response was
+                streamed, its rooms will be empty: see on_sync_room.
+        """
+        pass
+
+    def on_sync_room(self, room_id, room):
+        """Received a joined room from the initial sync.
+
+        Called for each room before on_sync.
+
+        Args:
+            room_id(str): The room ID.
+            room(dict): The room from the 'rooms.join' section of the sync.
+        """
+        pass
+
+    def get_checkpoint(self):
+        """Return state to save along with the sync token.
+
+        Plugins which build up state in on_sync or on_sync_room should return
+        it here, as neither is called when NEB resumes from a checkpoint.
+
+        Returns:
+            JSON-serialisable state, or None if there is nothing to save.
+        """
+        pass
+
+    def on_restore(self, checkpoint):
+        """Resuming from a checkpoint instead of performing an initial sync.
+
+        Args:
+            checkpoint: The state returned by get_checkpoint, or None if
+                nothing was saved for this plugin.
+        """
+        pass
+
+    def get_event_types(self):
+        """Return the event types this plugin wants to receive in on_event.
+
+        on_event is only called for events of these types, and they are used
+        to filter what the homeserver sends in /sync. This is read once, when
+        the plugin is added. Plugins which override on_event but return None
+        here get every event type except messages and membership changes.
+
+        Returns:
+            list<str>: The event types, or None for all event types.
         """
         pass
 
@@ -72,23 +190,88 @@ class PluginInterface(object):
         """Received an m.room.message event."""
         pass
 
+    def get_message_triggers(self):
+        """Return the messages which on_msg should be called for.
+
+        Only used if on_msg is overridden. Commands are not passed to on_msg.
+
+        Returns:
+            A list of neb.triggers.MessageTrigger, or None to be called for
+            every message.
+        """
+        pass
+
     def get_webhook_key(self):
         """Return a string for a webhook path if a webhook is required."""
         pass
 
-    def on_receive_webhook(self, data, ip, headers):
+    def verify_webhook(self, url, data, ip, headers):
+        """Check that a webhook request is genuine before it is accepted.
+
+        This is called whilst the sender waits for a response, so should not
+        do anything slow.
+
+        Args:
+            url(str): The URL which was hit
+            data(str): The request body
+            ip(str): The source IP address
+            headers: A dict of headers (via .get("headername"))
+        Returns:
+            A tuple of (response_body, http_status_code, header_dict) to
+            reject the request, or None to accept it. Raise an exception to
+            return a 500.
+        """
+        pass
+
+    def get_webhook_dedup_key(self, url, data, ip, headers):
+        """Return a key which identifies repeat deliveries of a webhook.
+
+        Requests with the same key as a recent request are dropped before
+        they are processed. Called after verify_webhook, whilst the sender
+        waits for a response.
+
+        Args:
+            url(str): The URL which was hit
+            data(str): The request body
+            ip(str): The source IP address
+            headers: A dict of headers (via .get("headername"))
+        Returns:
+            A string, or None to process every request.
+        """
+        pass
+
+    def on_receive_webhook(self, url, data, ip, headers):
         """Someone hit your webhook.
 
+        This is called on a background thread after verify_webhook accepted
+        the request and the sender has been sent a 202.
+
         Args:
+            url(str): The URL which was hit
             data(str): The request body
             ip(str): The source IP address
             headers: A dict of headers (via .get("headername"))
         Returns:
-            A tuple of (response_body, http_status_code, header_dict) or None
-            to return a 200 OK. Raise an exception to return a 500.
+            A tuple of (response_body, http_status_code, header_dict) or None.
+            A status code of 400 or more is logged as a failure.
         """
         pass
 
+    def on_spool_replay(self, spool_id, kind, data):
+        """Received an entry which this plugin put in the spool but did not
+        ack before NEB stopped.
+
+        Called once the plugins are set up, for kinds which start with
+        '<plugin name>.'. The plugin must ack the entry when it is done.
+
+        Args:
+            spool_id(int): The spool entry ID.
+            kind(str): The kind the entry was put with.
+            data: The entry.
+        """
+        log.warn("Dropping spool entry %s of unknown kind %s", spool_id, kind)
+        self.spool.ack(spool_id)
+
 
 class Plugin(PluginInterface):
 
@@ -102,38 +285,47 @@ class Plugin(PluginInterface):
         if len(args_array) == 0:
             raise CommandNotFoundError(self.__doc__)
 
-        # Structure is cmd_foo_bar_baz for "!foo bar baz"
-        # This starts by assuming a no-arg cmd then getting progressively
-        # more general until no args remain (in which case there isn't a match)
+        trie = type(self).__dict__.get("_command_trie")
+        if trie is None:
+            trie = compile_commands(type(self))
+
+        # Structure is cmd_foo_bar_baz for "!foo bar baz". Find the longest
+        # run of words which names a command; the rest are its args.
+        match = None
+        num_words = 0
+        node = trie
         for index, arg in enumerate(args_array):
-            possible_method = "cmd_" + "_".join(args_array[:(len(args_array) - index)])
             if self.config.case_insensitive:
-                possible_method = possible_method.lower()
-            if hasattr(self, possible_method):
-                method = getattr(self, possible_method)
-                remaining_args = [event] + args_array[len(args_array) - index:]
-
-                # function params prefixed with "opt_" should be None if they
-                # are not specified. This makes cmd definitions a lot nicer for
-                # plugins rather than a generic arg array or no optional extras
-                fn_param_names = inspect.getargspec(method)[0][1:]  # remove self
-                if len(fn_param_names) > len(remaining_args):
-                    # pad out the ones at the END marked "opt_" with None
-                    for i in reversed(fn_param_names):
-                        if i.startswith("opt_"):
-                            remaining_args.append(None)
-                        else:
-                            break
-
-                try:
-                    if remaining_args:
-                        return method(*remaining_args)
-                    else:
-                        return method()
-                except TypeError as e:
-                    log.exception(e)
-                    raise CommandNotFoundError(method.__doc__)
-
-        raise CommandNotFoundError("Unknown command")
+                arg = arg.lower()
+            for word in arg.split("_"):
+                node = node.children.get(word)
+                if node is None:
+                    break
+            if node is None:
+                break
+            if node.method_name:
+                match = node
+                num_words = index + 1
+
+        if not match:
+            raise CommandNotFoundError("Unknown command")
+
+        method = getattr(self, match.method_name)
+        remaining_args = [event] + args_array[num_words:]
+
+        # function params prefixed with "opt_" should be None if they
+        # are not specified. This makes cmd definitions a lot nicer for
+        # plugins rather than a generic arg array or no optional extras
+        if match.num_params > len(remaining_args):
+            # pad out the ones at the END marked "opt_" with None
+            remaining_args.extend([None] * match.num_trailing_opt)
+
+        timer = COMMAND_SECONDS.labels(self.name, match.method_name[4:]).time()
+        try:
+            with timer:
+                return method(*remaining_args)
+        except TypeError as e:
+            log.exception(e)
+            raise CommandNotFoundError(method.__doc__)
 
 
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""An append-only log of work which has been accepted but not yet done.
+
+Entries are written to segment files as JSON lines, one 'put' record per
+entry and one 'ack' record once it has been delivered. Entries which were not
+acknowledged are replayed when NEB restarts. Segments are deleted once every
+entry in them has been acknowledged.
+"""
+import json
+import os
+import threading
+
+import logging as log
+
+
+class Segment(object):
+    """A file of spool records."""
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = 0  # the number of unacknowledged entries put here
+
+
+class Spool(object):
+    """A durable queue of entries awaiting delivery."""
+
+    SEGMENT_BYTES = 4 * 1024 * 1024
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES):
+        """Open the spool, creating it if needed.
+
+        Args:
+            directory(str): The directory to keep the segment files in.
+            segment_bytes(int): The size at which to start a new segment.
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.cond = threading.Condition()
+        self.segments = []  # oldest first, the last one is being written to
+        self.pending = {
+        #    entry_id : Segment the entry was put in
+        }
+        self.next_id = 1
+        self.next_segment = 1
+        self.file = None
+
+        # for batching fsyncs
+        self.written = 0  # the number of records written
+        self.synced = 0  # the number of records known to be on disk
+        self.syncing = False
+
+        self._load()
+        self.replay_until = self.next_id
+        # always start a new segment, in case the last one ends in a torn
+        # write from a crash
+        self._open_segment()
+        self._compact()
+
+    def put(self, kind, data, sync=True):
+        """Add an entry to the spool.
+
+        Args:
+            kind(str): What sort of entry this is, for replay().
+            data: The JSON-serialisable entry.
+            sync(bool): True to wait until the entry is on disk. If False,
+                call sync() before relying on the entry being durable.
+        Returns:
+            int: The entry ID, to ack() with once it has been delivered.
+        """
+        with self.cond:
+            entry_id = self.next_id
+            self.next_id += 1
+            segment = self.segments[-1]
+            self._append({"op": "put", "id": entry_id, "kind": kind,
+                          "data": data})
+            self.pending[entry_id] = segment
+            segment.pending += 1
+        if sync:
+            self.sync()
+        return entry_id
+
+    def ack(self, entry_id):
+        """Mark an entry as delivered so it won't be replayed."""
+        with self.cond:
+            segment = self.pending.pop(entry_id, None)
+            if not segment:
+                return
+            segment.pending -= 1
+            self._append({"op": "ack", "id": entry_id})
+            self._compact()
+
+    def sync(self):
+        """Block until everything written so far is on disk.
+
+        Concurrent callers share a single fsync.
+        """
+        with self.cond:
+            target = self.written
+            while self.synced < target:
+                if self.syncing:
+                    self.cond.wait()
+                    continue
+                self.syncing = True
+                upto = self.written
+                # the file may be rotated and closed whilst we fsync
+                fd = os.dup(self.file.fileno())
+                self.cond.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                    self.cond.acquire()
+                    self.syncing = False
+                    self.cond.notify_all()
+                self.synced = max(self.synced, upto)
+
+    def pending_count(self):
+        with self.cond:
+            return len(self.pending)
+
+    def replay(self):
+        """Read the entries which were undelivered when the spool was opened.
+
+        Entries are read from disk as they are needed, oldest first.
+
+        Yields:
+            Tuples of (entry_id, kind, data).
+        """
+        with self.cond:
+            segments = list(self.segments[:-1])
+        for segment in segments:
+            try:
+                f = open(segment.path, 'r')
+            except IOError:
+                continue  # everything in it has been delivered since
+            with f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if (record["op"] != "put" or
+                            record["id"] >= self.replay_until):
+                        continue
+                    with self.cond:
+                        undelivered = record["id"] in self.pending
+                    if undelivered:
+                        yield (record["id"], record["kind"], record["data"])
+
+    def _load(self):
+        names = sorted(
+            n for n in os.listdir(self.directory) if n.endswith(".log")
+        )
+        acked = set()
+        for name in names:
+            segment = Segment(os.path.join(self.directory, name))
+            self.next_segment = max(self.next_segment, int(name[:-4]) + 1)
+            with open(segment.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        log.warn("Ignoring torn record in %s", segment.path)
+                        continue
+                    if record["op"] == "put":
+                        self.pending[record["id"]] = segment
+                        self.next_id = max(self.next_id, record["id"] + 1)
+                    elif record["op"] == "ack":
+                        acked.add(record["id"])
+            self.segments.append(segment)
+
+        for entry_id in acked:
+            self.pending.pop(entry_id, None)
+        for segment in self.pending.values():
+            segment.pending += 1
+        if self.pending:
+            log.info("Spool has %s undelivered entries", len(self.pending))
+
+    def _open_segment(self):
+        # must be called with self.cond held, or from __init__
+        path = os.path.join(self.directory, "%010d.log" % self.next_segment)
+        self.next_segment += 1
+        self.file = open(path, 'a')
+        self.segments.append(Segment(path))
+
+    def _append(self, record):
+        # must be called with self.cond held
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.written += 1
+        if self.file.tell() >= self.segment_bytes:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.synced = self.written
+            self.file.close()
+            self._open_segment()
+
+    def _compact(self):
+        # must be called with self.cond held. Segments are only removed from
+        # the front, so acks are never deleted before the entries they ack.
+        while len(self.segments) > 1 and self.segments[0].pending == 0:
+            segment = self.segments.pop(0)
+            try:
+                os.remove(segment.path)
+            except OSError as e:
+                log.error("Failed to remove spool segment %s: %s",
+                          segment.path, e)
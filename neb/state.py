@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""Room state which is tracked on behalf of plugins."""
+import copy
+import threading
+
+import logging as log
+
+
+class RoomContextStore(object):
+    """Stores state events for rooms.
+
+    The engine keeps a single store which is shared by every plugin. Plugins
+    subscribe to the event types they need with view().
+    """
+
+    def __init__(self, event_types, content_only=True):
+        """Init the store.
+
+        Args:
+            event_types(list<str>): The state event types to store.
+            content_only(bool): True to only store the content for state events.
+        """
+        self.state = {}
+        self.types = set(event_types)
+        self.content_only = content_only
+        self.rooms_by_type = {
+        #    event_type : set of room IDs with state of this type
+        }
+        self.indexes = {
+        #    (event_type, field) : { value : set of (room_id, state_key) }
+        }
+        self.listeners = {
+        #    event_type : list of functions to call when the state changes
+        }
+        self.lock = threading.RLock()
+
+    def add_types(self, event_types):
+        """Start storing more state event types."""
+        with self.lock:
+            self.types.update(event_types)
+
+    def view(self, event_types):
+        """Subscribe to state event types.
+
+        Args:
+            event_types(list<str>): The state event types to store.
+        Returns:
+            RoomContextView: A read-only view of the state for these types.
+        """
+        self.add_types(event_types)
+        return RoomContextView(self, event_types)
+
+    def add_index(self, event_type, field):
+        """Index rooms by the values of a field in a state event's content.
+
+        If the field is a list, each item in the list is indexed.
+
+        Args:
+            event_type(str): The state event type.
+            field(str): The content key to index.
+        """
+        with self.lock:
+            if (event_type, field) in self.indexes:
+                return
+            self.indexes[(event_type, field)] = {}
+            for room_id in self.state:
+                for key in self.state[room_id]:
+                    if key[0] == event_type:
+                        self._index(room_id, key, self.state[room_id][key])
+
+    def add_listener(self, event_type, fn):
+        """Call a function whenever state of a type is set or removed.
+
+        The function is called with the existing state straight away, then
+        with each change. It is called with the store locked, so it must not
+        call back into the store.
+
+        Args:
+            event_type(str): The state event type.
+            fn: The function to call with (room_id, state_key, content), where
+                content is None if the state was removed.
+        """
+        with self.lock:
+            self.listeners.setdefault(event_type, []).append(fn)
+            for room_id in self.state:
+                for key in self.state[room_id]:
+                    if key[0] == event_type:
+                        fn(room_id, key[1],
+                           self._content(self.state[room_id][key]))
+
+    def get_content(self, room_id, event_type, key=""):
+        return self._content(self.state[room_id][(event_type, key)])
+
+    def get_room_ids(self):
+        return self.state.keys()
+
+    def get_room_ids_with(self, event_type):
+        """Return the IDs of the rooms which have state of the given type."""
+        with self.lock:
+            return list(self.rooms_by_type.get(event_type, []))
+
+    def has_state(self, room_id, event_type):
+        """Return True if the room has state of the given type."""
+        with self.lock:
+            return room_id in self.rooms_by_type.get(event_type, ())
+
+    def get_room_ids_for(self, event_type, field, value):
+        """Return the IDs of the rooms whose state has a value for a field.
+
+        The field must have been indexed with add_index().
+
+        Args:
+            event_type(str): The state event type.
+            field(str): The indexed content key.
+            value: The value to look up.
+        Returns:
+            list<str>: The room IDs.
+        """
+        with self.lock:
+            entries = self.indexes[(event_type, field)].get(value, ())
+            return list(set(room_id for (room_id, state_key) in entries))
+
+    def update(self, event):
+        try:
+            room_id = event["room_id"]
+            etype = event["type"]
+            if etype in self.types:
+                with self.lock:
+                    if room_id not in self.state:
+                        self.state[room_id] = {}
+                    self._set(room_id, (etype, event["state_key"]), event)
+        except KeyError:
+            pass
+
+    def init_from_sync(self, sync):
+        for room_id in sync["rooms"]["join"]:
+            # see if we know anything about these rooms
+            self.init_room(room_id, sync["rooms"]["join"][room_id])
+
+    def init_room(self, room_id, room):
+        """Replace the state for a room with the state from a sync.
+
+        Args:
+            room_id(str): The room ID.
+            room(dict): The room from the 'rooms.join' section of a sync.
+        """
+        with self.lock:
+            self._clear_room(room_id)
+            self.state[room_id] = {}
+
+            try:
+                for state in room["state"]["events"]:
+                    if state["type"] in self.types:
+                        key = (state["type"], state["state_key"])
+                        self._set(room_id, key, state)
+            except KeyError:
+                pass
+
+    def snapshot(self):
+        """Return the stored state in a form which can be saved as JSON."""
+        with self.lock:
+            return dict(
+                (room_id, [
+                    [etype, state_key, self.state[room_id][(etype, state_key)]]
+                    for (etype, state_key) in self.state[room_id]
+                ])
+                for room_id in self.state
+            )
+
+    def restore(self, snapshot):
+        """Replace the stored state with a snapshot.
+
+        Args:
+            snapshot(dict): The result of a previous call to snapshot().
+        """
+        with self.lock:
+            for room_id in self.state.keys():
+                self._clear_room(room_id)
+            for room_id in snapshot:
+                self.state[room_id] = {}
+                for (etype, state_key, s) in snapshot[room_id]:
+                    if etype in self.types:
+                        self._set(room_id, (etype, state_key), s, stored=True)
+        log.debug("Restored state for %s rooms", len(self.state))
+
+    def _set(self, room_id, key, event, stored=False):
+        # must be called with self.lock held
+        s = event
+        if self.content_only and not stored:
+            s = event["content"]
+        if key in self.state[room_id]:
+            self._unindex(room_id, key, self.state[room_id][key])
+        self.state[room_id][key] = s
+        self.rooms_by_type.setdefault(key[0], set()).add(room_id)
+        self._index(room_id, key, s)
+        self._notify(room_id, key, self._content(s))
+
+    def _clear_room(self, room_id):
+        # must be called with self.lock held
+        for key in self.state.get(room_id, {}):
+            self.rooms_by_type[key[0]].discard(room_id)
+            self._unindex(room_id, key, self.state[room_id][key])
+            self._notify(room_id, key, None)
+        self.state.pop(room_id, None)
+
+    def _notify(self, room_id, key, content):
+        # must be called with self.lock held
+        for fn in self.listeners.get(key[0], []):
+            try:
+                fn(room_id, key[1], content)
+            except Exception as e:
+                log.exception(e)
+
+    def _content(self, s):
+        return s if self.content_only else s["content"]
+
+    def _index_values(self, key, s):
+        # yields (index, value) for each indexed value in the state
+        for (etype, field) in self.indexes:
+            if etype != key[0]:
+                continue
+            try:
+                values = self._content(s)[field]
+            except (KeyError, TypeError):
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                try:
+                    hash(value)
+                except TypeError:
+                    continue  # can't index dicts or lists
+                yield self.indexes[(etype, field)], value
+
+    def _index(self, room_id, key, s):
+        # must be called with self.lock held
+        for index, value in self._index_values(key, s):
+            index.setdefault(value, set()).add((room_id, key[1]))
+
+    def _unindex(self, room_id, key, s):
+        # must be called with self.lock held
+        for index, value in self._index_values(key, s):
+            entries = index.get(value)
+            if entries is not None:
+                entries.discard((room_id, key[1]))
+                if not entries:
+                    del index[value]
+
+
+class RoomContextView(object):
+    """A read-only view of a RoomContextStore for some state event types."""
+
+    def __init__(self, store, event_types):
+        self.store = store
+        self.types = list(event_types)
+
+    def get_content(self, room_id, event_type, key=""):
+        """Return a copy of the content of a state event.
+
+        Raises:
+            KeyError: If there is no such state event in the room.
+        """
+        if event_type not in self.types:
+            raise KeyError(event_type)
+        with self.store.lock:
+            return copy.deepcopy(
+                self.store.get_content(room_id, event_type, key)
+            )
+
+    def get_room_ids(self):
+        """Return the IDs of all the rooms the bot is in."""
+        with self.store.lock:
+            return list(self.store.get_room_ids())
+
+    def get_room_ids_with(self, event_type):
+        """Return the IDs of the rooms which have state of the given type."""
+        if event_type not in self.types:
+            return []
+        return self.store.get_room_ids_with(event_type)
+
+    def add_index(self, event_type, field):
+        """Index rooms by a content field: see RoomContextStore.add_index."""
+        self.store.add_index(event_type, field)
+
+    def get_room_ids_for(self, event_type, field, value):
+        """Return the IDs of the rooms whose state has a value for a field."""
+        if event_type not in self.types:
+            return []
+        return self.store.get_room_ids_for(event_type, field, value)
+
+    def add_listener(self, event_type, fn):
+        """Watch for state changes: see RoomContextStore.add_listener."""
+        if event_type not in self.types:
+            raise KeyError(event_type)
+        self.store.add_listener(event_type, fn)
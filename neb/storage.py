@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Helpers for keeping state on disk."""
+import atexit
+import copy
+import errno
+import json
+import os
+import threading
+import time
+
+import logging as log
+
+
+def write_atomically(path, contents):
+    """Replace the file at path with contents.
+
+    The contents are written to a temporary file which is then renamed over
+    the original, so readers see either the old file or the new one, never a
+    partial write.
+
+    Args:
+        path(str): The file to write.
+        contents(str): The new contents of the file.
+    """
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+    # make sure the rename itself survives a crash
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+class Checkpoint(object):
+    """The sync token and the room state which is known as of that token."""
+
+    VERSION = 2
+    INTERVAL_S = 30
+
+    def __init__(self, path, interval_s=INTERVAL_S):
+        """Create the checkpoint.
+
+        Args:
+            path(str): The file to store the checkpoint in.
+            interval_s(int): The min number of seconds between saves.
+        """
+        self.path = path
+        self.interval_s = interval_s
+        self.last_saved = 0
+
+    def load(self):
+        """Load the checkpoint.
+
+        Returns:
+            A dict with keys 'next_batch', 'rooms' and 'plugins', or None if
+            there is no usable checkpoint.
+        """
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except IOError:
+            return None
+        except ValueError as e:
+            log.error("Ignoring corrupt checkpoint %s: %s", self.path, e)
+            return None
+
+        if data.get("version") != Checkpoint.VERSION:
+            log.warn("Ignoring checkpoint with version %s",
+                     data.get("version"))
+            return None
+        return data
+
+    def is_due(self):
+        return time.time() - self.last_saved >= self.interval_s
+
+    def save(self, next_batch, rooms, plugin_state):
+        """Save the checkpoint.
+
+        Args:
+            next_batch(str): The token to resume syncing from.
+            rooms(dict): A snapshot of the RoomContextStore.
+            plugin_state(dict): Plugin name to the plugin's saved state.
+        """
+        write_atomically(self.path, json.dumps({
+            "version": Checkpoint.VERSION,
+            "next_batch": next_batch,
+            "rooms": rooms,
+            "plugins": plugin_state
+        }))
+        self.last_saved = time.time()
+
+
+class KeyValueStore(object):
+    """A persistent JSON store.
+
+    The whole store is written atomically to config_loc. Writes can be
+    debounced, so that a burst of set() calls costs a single write, and can
+    also be appended to a log at config_loc + '.log' which is folded back into
+    the store every LOG_COMPACT_ENTRIES entries.
+    """
+
+    SAVE_DELAY_S = 0
+    LOG_COMPACT_ENTRIES = 1000
+
+    def __init__(self, config_loc, version="1", save_delay_s=SAVE_DELAY_S,
+                 append_log=False):
+        """Load the store, creating it if needed.
+
+        Args:
+            config_loc(str): The file to store the JSON in.
+            version(str): The version to put in a new store.
+            save_delay_s(float): The number of seconds to wait after a set()
+                before saving, so that later calls are saved in the same
+                write. 0 to save straight away.
+            append_log(bool): True to append each set() to a log rather than
+                rewriting the whole store. Saves are then durable without
+                waiting for save_delay_s.
+        """
+        self.config = {
+            "version": version
+        }
+        self.config_loc = config_loc
+        self.log_loc = config_loc + ".log"
+        self.save_delay_s = save_delay_s
+        self.append_log = append_log
+        self.log_entries = 0
+        self.lock = threading.RLock()
+        self.timer = None  # set whilst a save is pending
+        self._load()
+        if save_delay_s > 0:
+            atexit.register(self.flush)
+
+    def _load(self):
+        try:
+            with open(self.config_loc, 'r') as f:
+                self.config = json.loads(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._save()
+        except ValueError as e:
+            # keep the broken file for a human to look at
+            log.error("Corrupt store %s, moving it to %s.corrupt: %s",
+                      self.config_loc, self.config_loc, e)
+            os.rename(self.config_loc, self.config_loc + ".corrupt")
+            self._save()
+
+        # the log holds changes made since the store was last written
+        torn = False
+        try:
+            with open(self.log_loc, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        log.warn("Ignoring torn entry in %s", self.log_loc)
+                        torn = True
+                        continue
+                    self.config[entry["key"]] = entry["value"]
+                    self.log_entries += 1
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        if torn or (self.log_entries and not self.append_log):
+            # don't append to a torn entry
+            self._save()
+
+    def _save(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            write_atomically(self.config_loc, json.dumps(self.config, indent=4))
+            # everything in the log is in the store now
+            try:
+                os.remove(self.log_loc)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            self.log_entries = 0
+
+    def _append(self, key, value):
+        with self.lock:
+            with open(self.log_loc, 'a') as f:
+                f.write(json.dumps({"key": key, "value": value}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            self.log_entries += 1
+            if self.log_entries >= KeyValueStore.LOG_COMPACT_ENTRIES:
+                self._save()
+
+    def flush(self):
+        """Save any changes which are waiting for save_delay_s."""
+        with self.lock:
+            if self.timer:
+                self._save()
+
+    def has(self, key):
+        return key in self.config
+
+    def set(self, key, value, save=True):
+        with self.lock:
+            self.config[key] = value
+            if not save:
+                return
+            if self.append_log:
+                self._append(key, value)
+            elif self.save_delay_s > 0:
+                if not self.timer:
+                    self.timer = threading.Timer(self.save_delay_s, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+            else:
+                self._save()
+
+    def get(self, key):
+        return self.config[key]
+
+    def update(self, key, fn):
+        """Replace a value with fn(value) atomically.
+
+        Args:
+            key(str): The key.
+            fn: Called with a copy of the current value, or None if there
+                isn't one, and returns the new value.
+        Returns:
+            The new value.
+        """
+        with self.lock:
+            old = self.config.get(key)
+            value = fn(copy.deepcopy(old))
+            if value != old:
+                self.set(key, value)
+            return value
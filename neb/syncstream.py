@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""Incremental parsing of /sync responses.
+
+Rather than loading the whole response into memory, rooms are yielded one at
+a time as they are read from the network, so the memory needed is
+proportional to the largest room rather than the whole account.
+
+Requires ijson, which is optional: see is_available().
+"""
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+SECTIONS = {
+    "rooms.join": "join",
+    "rooms.invite": "invite",
+    "rooms.leave": "leave"
+}
+
+
+def is_available():
+    return ijson is not None
+
+
+def iter_sync(f):
+    """Parse a /sync response from a file-like object.
+
+    Args:
+        f: The file-like object to read the JSON response from.
+    Yields:
+        Tuples of (section, room_id, room) where section is one of 'join',
+        'invite' or 'leave' and room is the parsed JSON for the room, or
+        ('next_batch', None, token).
+    """
+    parser = ijson.parse(f)
+    for prefix, event, value in parser:
+        if prefix == "next_batch" and event == "string":
+            yield ("next_batch", None, value)
+        elif prefix in SECTIONS and event == "map_key":
+            yield (SECTIONS[prefix], value, _build_value(parser))
+
+
+def _build_value(parser):
+    """Build the next complete JSON value from the parser."""
+    builder = ijson.common.ObjectBuilder()
+    depth = 0
+    for prefix, event, value in parser:
+        builder.event(event, value)
+        if event in ("start_map", "start_array"):
+            depth += 1
+        elif event in ("end_map", "end_array"):
+            depth -= 1
+        if depth == 0:
+            break
+    return builder.value
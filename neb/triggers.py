@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""Decides which plugins need to see a message.
+
+Plugins declare the messages they want with MessageTriggers. The triggers
+which apply to a room are combined into a single regex, so most messages are
+rejected with one search no matter how many plugins there are.
+"""
+import re
+import threading
+
+from neb.plugins import overrides
+
+
+class MessageTrigger(object):
+    """The messages a plugin's on_msg should be called for."""
+
+    def __init__(self, pattern, room_type=None):
+        """Create the trigger.
+
+        Args:
+            pattern(str): A regex which is searched for in the message body.
+                Must not contain inline flags like (?i).
+            room_type(str): Optional. Only trigger in rooms which have state
+                of this type. The plugin must have subscribed to the type with
+                its room store view.
+        """
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.room_type = room_type
+
+    @classmethod
+    def literal(cls, text, room_type=None):
+        """Trigger on messages which contain some text."""
+        return MessageTrigger(re.escape(text), room_type=room_type)
+
+
+class MessageRouter(object):
+    """Finds the plugins whose on_msg should be called for a message."""
+
+    def __init__(self, room_store):
+        """Create the router.
+
+        Args:
+            room_store(RoomContextStore): For checking room_type triggers.
+        """
+        self.room_store = room_store
+        self.always = []  # plugins which want every message
+        self.triggers = []  # (plugin name, MessageTrigger)
+        self.combined = {
+        #    tuple of indexes into self.triggers : compiled regex
+        }
+        self.lock = threading.Lock()
+
+    def add_plugin(self, name, plugin):
+        if not overrides(plugin, "on_msg"):
+            return  # costs nothing per message
+        triggers = plugin.get_message_triggers()
+        if triggers is None:
+            self.always.append(name)
+        else:
+            for trigger in triggers:
+                self.triggers.append((name, trigger))
+
+    def get_plugin_names(self, room_id, body):
+        """Return the names of the plugins to call on_msg for.
+
+        Args:
+            room_id(str): The room the message was sent in.
+            body(str): The message body.
+        Returns:
+            list<str>: The plugin names.
+        """
+        names = list(self.always)
+        active = tuple(
+            i for (i, (name, trigger)) in enumerate(self.triggers)
+            if trigger.room_type is None or
+            self.room_store.has_state(room_id, trigger.room_type)
+        )
+        if not active or not self._get_combined(active).search(body):
+            return names
+
+        if len(active) == 1:
+            matched = active
+        else:
+            matched = [
+                i for i in active if self.triggers[i][1].regex.search(body)
+            ]
+        for i in matched:
+            if self.triggers[i][0] not in names:
+                names.append(self.triggers[i][0])
+        return names
+
+    def _get_combined(self, indexes):
+        with self.lock:
+            if indexes not in self.combined:
+                self.combined[indexes] = re.compile("|".join(
+                    "(?:%s)" % self.triggers[i][1].pattern for i in indexes
+                ))
+            return self.combined[indexes]
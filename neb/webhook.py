@@ -1,58 +1,413 @@
 # -*- coding: utf-8 -*-
 """Devoted to services which use web hooks. Plugins are identified via the
 path being hit, which then delegates to the plugin to process.
+
+Requests are verified by the plugin and then queued, so the sender gets a
+response straight away rather than waiting for messages to be sent to rooms.
+
+The server also exports NEB's metrics on /metrics for Prometheus to scrape.
+
+The server is waitress if it is installed, otherwise Flask's threaded
+development server.
 """
 from flask import Flask
+from flask import jsonify
 from flask import request
+from neb import metrics
+from neb.cache import TTLCache
+from werkzeug.datastructures import Headers
+import base64
+import Queue
 import threading
+import time
 
 import logging as log
 
+try:
+    import waitress
+except ImportError:
+    waitress = None
+
 app = Flask("NebHookServer")
 
+REQUEST_SECONDS = metrics.histogram(
+    "neb_webhook_request_duration_seconds",
+    "The time taken to respond to webhook requests, by plugin webhook key.",
+    ["key"]
+)
+RESPONSES = metrics.counter(
+    "neb_webhook_responses_total",
+    "Webhook responses by plugin webhook key and status code.",
+    ["key", "code"]
+)
+PROCESS_SECONDS = metrics.histogram(
+    "neb_webhook_processing_duration_seconds",
+    "The time plugins took to process accepted webhooks.",
+    ["key"]
+)
+
+
+class WebhookRequest(object):
+    """A webhook request which has been accepted but not yet processed."""
+
+    def __init__(self, key, plugin, url, data, ip, headers):
+        self.key = key  # the plugin's webhook key
+        self.plugin = plugin
+        self.url = url
+        self.data = data
+        self.ip = ip
+        self.headers = headers
+        self.received = time.time()
+        self.spool_id = None  # set if the request is in the spool
+
+    def to_json(self):
+        return {
+            "key": self.key,
+            "url": self.url,
+            "data": base64.b64encode(self.data),
+            "ip": self.ip,
+            "headers": self.headers.items()
+        }
+
+    @classmethod
+    def from_json(cls, plugin, j):
+        return WebhookRequest(
+            j["key"],
+            plugin,
+            j["url"],
+            base64.b64decode(j["data"]),
+            j["ip"],
+            Headers([tuple(h) for h in j["headers"]])
+        )
+
+
+class WebhookPipeline(object):
+    """A bounded queue of webhook requests processed by worker threads."""
+
+    WORKERS = 4
+    MAX_QUEUE = 1000
+    SPOOL_KIND = "webhook"
+
+    def __init__(self, config=None, spool=None):
+        """Create the queue. Requests are queued until start() is called.
+
+        Args:
+            config(dict): Optional. Keys are 'workers' and 'max_queue'.
+            spool(Spool): Optional. Where to keep requests until they have
+                been processed.
+        """
+        config = config or {}
+        self.spool = spool
+        self.workers = config.get("workers", WebhookPipeline.WORKERS)
+        self.queue = Queue.Queue(
+            config.get("max_queue", WebhookPipeline.MAX_QUEUE)
+        )
+        self.lock = threading.Lock()
+        self.stats = {
+            "accepted": 0,
+            "rejected": 0,  # because the queue was full
+            "processed": 0,
+            "failed": 0,
+            "lag_s": 0,  # the time the last request spent queued
+            "max_lag_s": 0
+        }
+
+        metrics.QUEUE_DEPTH.labels("webhooks").set_function(self.queue_depth)
+
+    def start(self):
+        """Start the workers which process queued requests."""
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name="Webhook-%s" % i)
+            t.daemon = True
+            t.start()
+
+    def submit(self, webhook_request):
+        """Queue a request to be processed.
+
+        If there is a spool, this returns once the request is on disk.
+
+        Returns:
+            bool: False if the queue is full.
+        """
+        if self.queue.full():
+            return self._reject(webhook_request)
+        if self.spool:
+            webhook_request.spool_id = self.spool.put(
+                WebhookPipeline.SPOOL_KIND, webhook_request.to_json()
+            )
+        try:
+            # other request threads may have filled the queue since the check
+            self.queue.put_nowait(webhook_request)
+        except Queue.Full:
+            return self._reject(webhook_request)
+        with self.lock:
+            self.stats["accepted"] += 1
+        return True
+
+    def replay(self, webhook_request):
+        """Process a request from the spool and return when it is done.
+
+        Call this for each spooled request before start(), so that they are
+        processed one at a time, in the order they were received, and before
+        any requests which have arrived since.
+        """
+        with self.lock:
+            self.stats["accepted"] += 1
+        self._process(webhook_request)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queue_depth"] = self.queue_depth()
+        if self.spool:
+            stats["spooled"] = self.spool.pending_count()
+        return stats
+
+    def _reject(self, webhook_request):
+        if webhook_request.spool_id:
+            # the sender will retry it, so it mustn't be replayed as well
+            self.spool.ack(webhook_request.spool_id)
+            webhook_request.spool_id = None
+        with self.lock:
+            self.stats["rejected"] += 1
+        return False
+
+    def _run(self):
+        while True:
+            self._process(self.queue.get())
+
+    def _process(self, req):
+        lag_s = time.time() - req.received
+        with self.lock:
+            self.stats["lag_s"] = lag_s
+            self.stats["max_lag_s"] = max(self.stats["max_lag_s"], lag_s)
+
+        failed = False
+        try:
+            with PROCESS_SECONDS.labels(req.key).time():
+                response = req.plugin.on_receive_webhook(
+                    req.url, req.data, req.ip, req.headers
+                )
+            if response and response[1] >= 400:
+                log.warn("Webhook for %s from %s failed: %s",
+                         req.plugin, req.ip, response[1])
+                failed = True
+        except Exception as e:
+            log.exception(e)
+            failed = True
+
+        with self.lock:
+            self.stats["failed" if failed else "processed"] += 1
+
+        if req.spool_id:
+            # the messages it queued must be on disk before we forget it.
+            # Failed requests are not retried, as they would fail again.
+            self.spool.sync()
+            self.spool.ack(req.spool_id)
+
 
 class NebHookServer(threading.Thread):
 
-    def __init__(self, port):
+    HOST = "0.0.0.0"
+    PORT = 8500
+    SERVERS = ["auto", "waitress", "flask"]
+    THREADS = 8  # the number of requests waitress handles at once
+    CONNECTION_LIMIT = 100
+    KEEPALIVE_S = 60  # how long an idle connection is kept open for
+    MAX_BODY_BYTES = 1024 * 1024
+    RETRY_AFTER_S = 10  # sent when the pipeline is full
+
+    # for dropping repeat deliveries
+    DEDUP_MAX_SIZE = 10000
+    DEDUP_TTL_S = 60 * 60 * 24
+
+    def __init__(self, port, pipeline=None, host=HOST, config=None,
+                 registry=None):
+        """Create the server.
+
+        Args:
+            port(int): The port to listen on.
+            pipeline(WebhookPipeline): Optional. Processes accepted requests.
+                The caller must start() it. If omitted, one is started.
+            host(str): The address to listen on.
+            config(dict): Optional. Keys are 'server' (one of SERVERS),
+                'threads', 'connection_limit', 'keepalive_s',
+                'max_body_bytes', 'dedup_max_size' and 'dedup_ttl_s'.
+            registry(metrics.Registry): Optional. The metrics to serve on
+                /metrics, instead of NEB's own.
+        """
         super(NebHookServer, self).__init__()
+        config = config or {}
+        self.host = host
         self.port = port
+        self.pipeline = pipeline
+        if not self.pipeline:
+            self.pipeline = WebhookPipeline()
+            self.pipeline.start()
+        self.server = config.get("server", "auto")
+        if self.server not in NebHookServer.SERVERS:
+            raise ValueError("Unknown webhook server '%s', expected one of %s" %
+                             (self.server, NebHookServer.SERVERS))
+        if self.server == "auto":
+            self.server = "waitress" if waitress else "flask"
+        elif self.server == "waitress" and not waitress:
+            raise ValueError("The waitress webhook server is not installed")
+        self.threads = config.get("threads", NebHookServer.THREADS)
+        self.connection_limit = config.get(
+            "connection_limit", NebHookServer.CONNECTION_LIMIT
+        )
+        self.keepalive_s = config.get("keepalive_s", NebHookServer.KEEPALIVE_S)
+        self.max_body_bytes = config.get(
+            "max_body_bytes", NebHookServer.MAX_BODY_BYTES
+        )
+        self.registry = registry or metrics.registry
+        self.stats_fns = {
+        #    name : function returning a dict of stats for /_neb/stats
+        }
+        self.seen = TTLCache(
+            max_size=config.get("dedup_max_size", NebHookServer.DEDUP_MAX_SIZE),
+            ttl_s=config.get("dedup_ttl_s", NebHookServer.DEDUP_TTL_S)
+        )
+        self.duplicates = 0
         self.plugin_mappings = {
         #    plugin_key : plugin_instance
         }
 
         app.add_url_rule('/neb/<path:service>', '/neb/<path:service>',
                          self.do_POST, methods=["POST"])
+        app.add_url_rule('/_neb/stats', '/_neb/stats',
+                         self.do_GET_stats, methods=["GET"])
+        app.add_url_rule('/metrics', '/metrics',
+                         self.do_GET_metrics, methods=["GET"])
+
+    def add_stats(self, name, fn):
+        """Include the dict returned by fn in /_neb/stats under name."""
+        self.stats_fns[name] = fn
 
     def set_plugin(self, key, plugin):
         log.info("Registering plugin %s for webhook on /neb/%s" % (plugin, key))
         self.plugin_mappings[key] = plugin
 
     def do_POST(self, service=""):
+        start = time.time()
+        key = service.split("/")[0]
+        response = self._accept(key, service)
+        if key not in self.plugin_mappings:
+            key = ""  # so probes for random paths don't add labels
+        REQUEST_SECONDS.labels(key).observe(time.time() - start)
+        RESPONSES.labels(key, str(response[1])).inc()
+        return response
+
+    def _accept(self, key, service):
         log.debug("NebHookServer: Plugin=%s : Incoming request from %s",
                   service, request.remote_addr)
-        if service.split("/")[0] not in self.plugin_mappings:
+        if key not in self.plugin_mappings:
             return ("", 404, {})
 
-        plugin = self.plugin_mappings[service.split("/")[0]]
+        plugin = self.plugin_mappings[key]
+
+        if (request.content_length or 0) > self.max_body_bytes:
+            log.warn("Rejecting %s byte webhook for %s",
+                     request.content_length, service)
+            return ("", 413, {})
 
+        # copy the request, as it is processed after this context has gone
+        req = WebhookRequest(
+            key,
+            plugin,
+            request.url,
+            request.get_data(),
+            request.remote_addr,
+            Headers(request.headers)
+        )
         try:
             # tuple (body, status_code, headers)
-            response = plugin.on_receive_webhook(
-                request.url,
-                request.get_data(),
-                request.remote_addr,
-                request.headers
+            response = plugin.verify_webhook(
+                req.url, req.data, req.ip, req.headers
             )
             if response:
                 return response
-            return ("", 200, {})
+            dedup_key = plugin.get_webhook_dedup_key(
+                req.url, req.data, req.ip, req.headers
+            )
+        except Exception as e:
+            log.exception(e)
+            return ("", 500, {})
+
+        if dedup_key:
+            dedup_key = "%s/%s" % (key, dedup_key)
+            if not self.seen.add(dedup_key):
+                log.info("Dropping repeat webhook %s", dedup_key)
+                self.duplicates += 1
+                return ("", 200, {})
+
+        # the key is held whilst submitting so a concurrent repeat is dropped,
+        # but it is only kept if the request was accepted.
+        try:
+            submitted = self.pipeline.submit(req)
         except Exception as e:
             log.exception(e)
+            if dedup_key:
+                self.seen.invalidate(dedup_key)  # so the retry is processed
             return ("", 500, {})
+        if not submitted:
+            log.warn("Webhook queue full, rejecting request for %s", service)
+            if dedup_key:
+                self.seen.invalidate(dedup_key)  # so the retry is processed
+            return ("", 503, {
+                "Retry-After": str(NebHookServer.RETRY_AFTER_S)
+            })
+        return ("", 202, {})
+
+    def replay(self, spool_id, data):
+        """Process a webhook request from the spool, before the pipeline is
+        started.
+
+        Args:
+            spool_id(int): The request's spool entry.
+            data(dict): The result of WebhookRequest.to_json().
+        """
+        plugin = self.plugin_mappings.get(data["key"])
+        if not plugin:
+            log.warn("Dropping spooled webhook for /neb/%s", data["key"])
+            self.pipeline.spool.ack(spool_id)
+            return
+        req = WebhookRequest.from_json(plugin, data)
+        req.spool_id = spool_id
+        self.pipeline.replay(req)
+
+    def do_GET_stats(self):
+        stats = self.pipeline.get_stats()
+        stats["duplicates"] = self.duplicates
+        result = {"webhooks": stats}
+        for name in self.stats_fns:
+            result[name] = self.stats_fns[name]()
+        return jsonify(result)
+
+    def do_GET_metrics(self):
+        return (self.registry.render(), 200, {
+            "Content-Type": metrics.Registry.CONTENT_TYPE
+        })
 
     def notify_plugin(self, content):
         self.plugin.on_receive_github_push(content)
 
     def run(self):
-        log.info("Running NebHookServer")
-        app.run(host="0.0.0.0", port=self.port)
+        log.info("Running NebHookServer on %s:%s using %s",
+                 self.host, self.port, self.server)
+        if self.server == "waitress":
+            waitress.serve(
+                app,
+                host=self.host,
+                port=self.port,
+                threads=self.threads,
+                connection_limit=self.connection_limit,
+                channel_timeout=self.keepalive_s,
+                max_request_body_size=self.max_body_bytes,
+                ident="NebHookServer"
+            )
+        else:
+            app.run(host=self.host, port=self.port, threaded=True)
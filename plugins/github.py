@@ -1,11 +1,10 @@
 # -*- coding: utf-8 -*-
-from neb.engine import KeyValueStore, RoomContextStore
+from neb.engine import KeyValueStore
 from neb.plugins import Plugin, admin_only
 
 from hashlib import sha1
 import hmac
 import json
-import requests
 
 import logging as log
 
@@ -38,10 +37,12 @@ class GithubPlugin(Plugin):
 
     def __init__(self, *args, **kwargs):
         super(GithubPlugin, self).__init__(*args, **kwargs)
-        self.store = KeyValueStore("github.json")
-        self.rooms = RoomContextStore(
+        # new projects are added from webhooks, so batch up the writes
+        self.store = KeyValueStore("github.json", save_delay_s=1)
+        self.rooms = self.room_store.view(
             [GithubPlugin.TYPE_TRACK]
         )
+        self.rooms.add_index(GithubPlugin.TYPE_TRACK, "projects")
 
         if not self.store.has("known_projects"):
             self.store.set("known_projects", [])
@@ -63,10 +64,7 @@ class GithubPlugin(Plugin):
 
         # add the project if we didn't know about it before
         if info["repo"] not in self.store.get("known_projects"):
-            log.info("Added new repo: %s", info["repo"])
-            projects = self.store.get("known_projects")
-            projects.append(info["repo"])
-            self.store.set("known_projects", projects)
+            self._add_known_project(info["repo"])
 
         push_message = ""
 
@@ -114,16 +112,9 @@ class GithubPlugin(Plugin):
 
     def send_message_to_repos(self, repo, push_message):
         # send messages to all rooms registered with this project.
-        for room_id in self.rooms.get_room_ids():
-            try:
-                if repo in self.rooms.get_content(room_id, GithubPlugin.TYPE_TRACK)["projects"]:
-                    self.matrix.send_message_event(
-                        room_id,
-                        "m.room.message",
-                        self.matrix.get_html_body(push_message, msgtype="m.notice")
-                    )
-            except KeyError:
-                pass
+        for room_id in self.rooms.get_room_ids_for(
+                GithubPlugin.TYPE_TRACK, "projects", repo):
+            self.outbox.send_html(room_id, push_message)
 
     def cmd_show(self, event, action):
         """Show information on projects or projects being tracked.
@@ -239,7 +230,7 @@ class GithubPlugin(Plugin):
 
         for label in args:
             url = "https://api.github.com/repos/%s/issues/%s/labels/%s" % (repo, issue_num, label)
-            res = requests.delete(url, headers={
+            res = self.http.delete(url, headers={
                 "Authorization": "token %s" % self.store.get("github_access_token")
             })
             if res.status_code < 200 or res.status_code >= 300:
@@ -265,7 +256,7 @@ class GithubPlugin(Plugin):
             return "You must specify at least one label."
 
         url = "https://api.github.com/repos/%s/issues/%s/labels" % (repo, issue_num)
-        res = requests.post(url, data=json.dumps(args), headers={
+        res = self.http.post(url, data=json.dumps(args), headers={
             "Content-Type": "application/json",
             "Authorization": "token %s" % self.store.get("github_access_token")
         })
@@ -290,7 +281,7 @@ class GithubPlugin(Plugin):
         }
 
         url = "https://api.github.com/repos/%s/issues" % project
-        res = requests.post(url, data=json.dumps(info), headers={
+        res = self.http.post(url, data=json.dumps(info), headers={
             "Content-Type": "application/json",
             "Authorization": "token %s" % self.store.get("github_access_token")
         })
@@ -335,13 +326,6 @@ class GithubPlugin(Plugin):
         except KeyError:
             return "Not tracking any projects currently."
 
-    def on_event(self, event, event_type):
-        self.rooms.update(event)
-
-    def on_sync(self, sync):
-        log.debug("Plugin: Github sync state:")
-        self.rooms.init_from_sync(sync)
-
     def get_webhook_key(self):
         return "github"
 
@@ -393,10 +377,15 @@ class GithubPlugin(Plugin):
         repo_name = data.get("repository", {}).get("full_name")
         # add the project if we didn't know about it before
         if repo_name and repo_name not in self.store.get("known_projects"):
-            log.info("Added new repo: %s", repo_name)
-            projects = self.store.get("known_projects")
-            projects.append(repo_name)
-            self.store.set("known_projects", projects)
+            self._add_known_project(repo_name)
+
+    def _add_known_project(self, repo):
+        # webhooks are processed concurrently, so update the list atomically
+        log.info("Added new repo: %s", repo)
+        self.store.update(
+            "known_projects",
+            lambda projects: projects if repo in projects else projects + [repo]
+        )
 
     def on_receive_comment(self, data):
         repo_name = data["repository"]["full_name"]
@@ -486,7 +475,7 @@ class GithubPlugin(Plugin):
         self.send_message_to_repos(repo_name, msg)
 
 
-    def on_receive_webhook(self, url, data, ip, headers):
+    def verify_webhook(self, url, data, ip, headers):
         if self.store.get("secret_token"):
             token_sha1 = headers.get('X-Hub-Signature')
             payload_body = data
@@ -498,6 +487,11 @@ class GithubPlugin(Plugin):
                          ip)
                 return ("", 403, {})
 
+    def get_webhook_dedup_key(self, url, data, ip, headers):
+        # github retries failed deliveries with the same ID
+        return headers.get('X-GitHub-Delivery')
+
+    def on_receive_webhook(self, url, data, ip, headers):
         json_data = json.loads(data)
         is_private_repo = json_data.get("repository", {}).get("private")
         if is_private_repo:
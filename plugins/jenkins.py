@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from neb.plugins import Plugin, admin_only
-from neb.engine import KeyValueStore, RoomContextStore
+from neb.engine import KeyValueStore
 
 import json
 import urlparse
@@ -36,10 +36,12 @@ class JenkinsPlugin(Plugin):
 
     def __init__(self, *args, **kwargs):
         super(JenkinsPlugin, self).__init__(*args, **kwargs)
-        self.store = KeyValueStore("jenkins.json")
-        self.rooms = RoomContextStore(
+        # jobs are added as their first build is reported, so save lazily
+        self.store = KeyValueStore("jenkins.json", save_delay_s=1)
+        self.rooms = self.room_store.view(
             [JenkinsPlugin.TYPE_TRACK]
         )
+        self.rooms.add_index(JenkinsPlugin.TYPE_TRACK, "projects")
 
         if not self.store.has("known_projects"):
             self.store.set("known_projects", [])
@@ -147,28 +149,44 @@ class JenkinsPlugin(Plugin):
 
     def send_message_to_repos(self, repo, push_message):
         # send messages to all rooms registered with this project.
-        for room_id in self.rooms.get_room_ids():
-            try:
-                if (repo in self.rooms.get_content(
-                        room_id, JenkinsPlugin.TYPE_TRACK)["projects"]):
-                    self.matrix.send_message_event(
-                        room_id,
-                        "m.room.message",
-                        self.matrix.get_html_body(push_message, msgtype="m.notice")
-                    )
-            except KeyError:
-                pass
-
-    def on_event(self, event, event_type):
-        self.rooms.update(event)
-
-    def on_sync(self, sync):
-        log.debug("Plugin: Jenkins sync state:")
-        self.rooms.init_from_sync(sync)
+        for room_id in self.rooms.get_room_ids_for(
+                JenkinsPlugin.TYPE_TRACK, "projects", repo):
+            self.outbox.send_html(room_id, push_message)
+
+    def _add_known_project(self, name):
+        # builds can be reported at the same time, so don't append in place
+        log.info("Added new job: %s", name)
+        self.store.update(
+            "known_projects",
+            lambda projects: projects if name in projects else projects + [name]
+        )
 
     def get_webhook_key(self):
         return "jenkins"
 
+    def verify_webhook(self, url, data, ip, headers):
+        query_dict = urlparse.parse_qs(urlparse.urlparse(url).query)
+        if self.store.get("secret_token"):
+            if "secret" not in query_dict:
+                log.warn("Jenkins webhook: Missing secret.")
+                return ("", 403, {})
+
+            # The jenkins Notification plugin does not support any sort of
+            # "execute this code on this json object before you send" so we can't
+            # send across HMAC SHA1s like with github :( so a secret token will
+            # have to do.
+            secrets = query_dict["secret"]
+            if len(secrets) > 1:
+                log.warn("Jenkins webhook: FAILED SECRET TOKEN AUTH. Too many secrets. IP=%s",
+                         ip)
+                return ("", 403, {})
+            elif secrets[0] != self.store.get("secret_token"):
+                log.warn("Jenkins webhook: FAILED SECRET TOKEN AUTH. Mismatch. IP=%s",
+                         ip)
+                return ("", 403, {})
+            else:
+                log.info("Jenkins webhook: Secret verified.")
+
     def on_receive_webhook(self, url, data, ip, headers):
         # data is of the form:
         # {
@@ -195,35 +213,9 @@ class JenkinsPlugin(Plugin):
         j = json.loads(data)
         name = j["name"]
 
-        query_dict = urlparse.parse_qs(urlparse.urlparse(url).query)
-        if self.store.get("secret_token"):
-            if "secret" not in query_dict:
-                log.warn("Jenkins webhook: Missing secret.")
-                return ("", 403, {})
-            
-            # The jenkins Notification plugin does not support any sort of
-            # "execute this code on this json object before you send" so we can't
-            # send across HMAC SHA1s like with github :( so a secret token will
-            # have to do.
-            secrets = query_dict["secret"]
-            if len(secrets) > 1:
-                log.warn("Jenkins webhook: FAILED SECRET TOKEN AUTH. Too many secrets. IP=%s",
-                         ip)
-                return ("", 403, {})
-            elif secrets[0] != self.store.get("secret_token"):
-                log.warn("Jenkins webhook: FAILED SECRET TOKEN AUTH. Mismatch. IP=%s",
-                         ip)
-                return ("", 403, {})
-            else:
-                log.info("Jenkins webhook: Secret verified.")
-
-
         # add the project if we didn't know about it before
         if name not in self.store.get("known_projects"):
-            log.info("Added new job: %s", name)
-            projects = self.store.get("known_projects")
-            projects.append(name)
-            self.store.set("known_projects", projects)
+            self._add_known_project(name)
 
         status = j["build"]["status"]
         branch = None
@@ -1,10 +1,11 @@
-from neb.engine import KeyValueStore, RoomContextStore
+from neb.cache import TTLCache
+from neb.engine import KeyValueStore
 from neb.plugins import Plugin, admin_only
+from neb.triggers import MessageTrigger
 
 import getpass
 import json
 import re
-import requests
 
 import logging as log
 
@@ -18,6 +19,7 @@ class JiraPlugin(Plugin):
     jira stop expand|expansion|expanding : Stop expanding jira issues.
     jira show track|tracking : Show which projects are being tracked.
     jira show expansion|expand|expanding : Show which project keys will result in issue expansion.
+    jira show cache : Show how often issue expansions are served from the cache.
     jira create <project> <priority> <title> <desc> : Create a new JIRA issue.
     jira comment <issue-id> <comment> : Comment on a JIRA issue.
     """
@@ -35,12 +37,25 @@ class JiraPlugin(Plugin):
     TYPE_TRACK = "org.matrix.neb.plugin.jira.issues.tracking"
     TYPE_EXPAND = "org.matrix.neb.plugin.jira.issues.expanding"
 
+    ISSUE_KEY_PATTERN = r"\b(([A-Za-z]+)-\d+)\b"
+
+    # issue summaries are cached until JIRA tells us they have changed, or
+    # for this long if we miss the webhook.
+    CACHE_SIZE = 1000
+    CACHE_TTL_S = 60 * 10
+
+    # the max number of issues to look up in a single search request, and
+    # the fields needed to summarise them.
+    SEARCH_BATCH_SIZE = 50
+    SUMMARY_FIELDS = ["summary", "status", "priority", "reporter", "assignee"]
+
     def __init__(self, *args, **kwargs):
         super(JiraPlugin, self).__init__(*args, **kwargs)
         self.store = KeyValueStore("jira.json")
-        self.rooms = RoomContextStore(
+        self.rooms = self.room_store.view(
             [JiraPlugin.TYPE_TRACK, JiraPlugin.TYPE_EXPAND]
         )
+        self.rooms.add_index(JiraPlugin.TYPE_TRACK, "projects")
 
         if not self.store.has("url"):
             url = raw_input("JIRA URL: ").strip()
@@ -53,7 +68,10 @@ class JiraPlugin(Plugin):
             self.store.set("pass", pw)
 
         self.auth = (self.store.get("user"), self.store.get("pass"))
-        self.regex = re.compile(r"\b(([A-Za-z]+)-\d+)\b")
+        self.regex = re.compile(JiraPlugin.ISSUE_KEY_PATTERN)
+        self.issue_cache = TTLCache(
+            max_size=JiraPlugin.CACHE_SIZE, ttl_s=JiraPlugin.CACHE_TTL_S
+        )
 
     @admin_only
     def cmd_stop(self, event, action):
@@ -157,7 +175,7 @@ class JiraPlugin(Plugin):
     def cmd_version(self, event):
         """Display version information for the configured JIRA platform. 'jira version'"""
         url = self._url("/rest/api/2/serverInfo")
-        response = json.loads(requests.get(url).text)
+        response = json.loads(self.http.get(url).text)
 
         info = "%s : version %s : build %s" % (response["serverTitle"],
                response["version"], response["buildNumber"])
@@ -168,12 +186,18 @@ class JiraPlugin(Plugin):
         """Show which project keys are being tracked/expanded.
         Show which project keys are being expanded. 'jira show expanding'
         Show which project keys are being tracked. 'jira show tracking'
+        Show issue cache statistics. 'jira show cache'
         """
         action = action.lower()
         if action in self.TRACK:
             return self._get_tracking(event["room_id"])
         elif action in self.EXPAND:
             return self._get_expanding(event["room_id"])
+        elif action == "cache":
+            stats = self.issue_cache.get_stats()
+            return "Cached issues: %s (hits=%s, misses=%s)" % (
+                stats["size"], stats["hits"], stats["misses"]
+            )
 
     def _get_tracking(self, room_id):
         try:
@@ -210,6 +234,14 @@ class JiraPlugin(Plugin):
             }
         )
 
+    def get_message_triggers(self):
+        # only messages which mention an issue in rooms which expand them
+        return [
+            MessageTrigger(
+                JiraPlugin.ISSUE_KEY_PATTERN, room_type=JiraPlugin.TYPE_EXPAND
+            )
+        ]
+
     def on_msg(self, event, body):
         room_id = event["room_id"]
         body = body.upper()
@@ -225,21 +257,23 @@ class JiraPlugin(Plugin):
         except KeyError:
             return
 
+        # each issue is only expanded once, in the order they were mentioned.
+        keys = []
         for (key, project) in groups:
-            if project in projects:
-                try:
-                    issue_info = self._get_issue_info(key)
-                    if issue_info:
-                        self.matrix.send_message(
-                            event["room_id"],
-                            issue_info,
-                            msgtype="m.notice"
-                        )
-                except Exception as e:
-                    log.exception(e)
-
-    def on_event(self, event, event_type):
-        self.rooms.update(event)
+            if project in projects and key not in keys:
+                keys.append(key)
+        if not keys:
+            return
+
+        try:
+            issue_infos = self._get_issue_infos(keys)
+        except Exception as e:
+            log.exception(e)
+            return
+
+        lines = [issue_infos[key] for key in keys if key in issue_infos]
+        if lines:
+            self.outbox.send_message(event["room_id"], "\n".join(lines))
 
     def on_receive_jira_push(self, info):
         log.debug("on_recv %s", info)
@@ -251,37 +285,57 @@ class JiraPlugin(Plugin):
                        info["key"], info["summary"], link)
 
         # send messages to all rooms registered with this project.
-        for room_id in self.rooms.get_room_ids():
-            try:
-                content = self.rooms.get_content(room_id, JiraPlugin.TYPE_TRACK)
-                if project in content["projects"]:
-                    self.matrix.send_message_event(
-                        room_id,
-                        "m.room.message",
-                        self.matrix.get_html_body(push_message, msgtype="m.notice")
-                    )
-            except KeyError:
-                pass
-
-    def on_sync(self, sync):
-        log.debug("Plugin: JIRA sync state:")
-        self.rooms.init_from_sync(sync)
-
-    def _get_issue_info(self, issue_key):
-        url = self._url("/rest/api/2/issue/%s" % issue_key)
-        res = requests.get(url, auth=self.auth)
-        if res.status_code != 200:
-            return
+        for room_id in self.rooms.get_room_ids_for(
+                JiraPlugin.TYPE_TRACK, "projects", project):
+            self.outbox.send_html(room_id, push_message)
 
-        response = json.loads(res.text)
+    def _get_issue_infos(self, issue_keys):
+        """Return a dict of issue key to a one-line summary of the issue.
+
+        Issues which aren't cached are looked up with a single JQL search
+        rather than a request per issue. Unknown issues are left out.
+        """
+        infos = {}
+        missing = []
+        for key in issue_keys:
+            info = self.issue_cache.get(key)
+            if info:
+                infos[key] = info
+            else:
+                missing.append(key)
+
+        url = self._url("/rest/api/2/search")
+        for i in range(0, len(missing), JiraPlugin.SEARCH_BATCH_SIZE):
+            batch = missing[i:i + JiraPlugin.SEARCH_BATCH_SIZE]
+            res = self.http.get(url, auth=self.auth, params={
+                "jql": "key in (%s)" % ",".join(batch),
+                "fields": ",".join(JiraPlugin.SUMMARY_FIELDS),
+                "maxResults": len(batch),
+                # don't fail the whole search if one of the keys is unknown
+                "validateQuery": "false"
+            })
+            if res.status_code != 200:
+                log.error("JIRA search failed: HTTP %s - %s",
+                          res.status_code, res.text)
+                continue
+
+            response = json.loads(res.text)
+            for issue in response["issues"]:
+                info = self._get_issue_info(issue["key"], issue["fields"])
+                self.issue_cache.set(issue["key"], info)
+                infos[issue["key"]] = info
+
+        return infos
+
+    def _get_issue_info(self, issue_key, fields):
         link = self._linkify(issue_key)
-        desc = response["fields"]["summary"]
-        status = response["fields"]["status"]["name"]
-        priority = response["fields"]["priority"]["name"]
-        reporter = response["fields"]["reporter"]["displayName"]
+        desc = fields["summary"]
+        status = fields["status"]["name"]
+        priority = fields["priority"]["name"]
+        reporter = fields["reporter"]["displayName"]
         assignee = ""
-        if response["fields"]["assignee"]:
-            assignee = response["fields"]["assignee"]["displayName"]
+        if fields["assignee"]:
+            assignee = fields["assignee"]["displayName"]
 
         info = "%s : %s [%s,%s,reporter=%s,assignee=%s]" % (link, desc, status,
                priority, reporter, assignee)
@@ -312,7 +366,7 @@ class JiraPlugin(Plugin):
         }
 
         url = self._url("/rest/api/2/issue")
-        res = requests.post(url, auth=self.auth, data=json.dumps(info), headers={
+        res = self.http.post(url, auth=self.auth, data=json.dumps(info), headers={
             "Content-Type": "application/json"
         })
 
@@ -334,7 +388,7 @@ class JiraPlugin(Plugin):
         }
 
         url = self._url("/rest/api/2/issue/%s/comment" % key)
-        res = requests.post(url, auth=self.auth, data=json.dumps(info), headers={
+        res = self.http.post(url, auth=self.auth, data=json.dumps(info), headers={
             "Content-Type": "application/json"
         })
 
@@ -358,6 +412,8 @@ class JiraPlugin(Plugin):
         j = json.loads(data)
 
         info = self.get_webhook_json_keys(j)
+        if info["action"] in ["updated", "deleted"]:
+            self.issue_cache.invalidate(info["key"])
         self.on_receive_jira_push(info)
 
     def get_webhook_json_keys(self, j):
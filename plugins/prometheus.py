@@ -1,105 +1,555 @@
 # -*- coding: utf-8 -*-
-from jinja2 import Template
+from jinja2 import FileSystemBytecodeCache, FunctionLoader, TemplateNotFound
+from jinja2.sandbox import SandboxedEnvironment
+from hashlib import sha1
+import cgi
 import json
-from matrix_client.api import MatrixRequestError
-from neb.engine import KeyValueStore, RoomContextStore
+import re
+import threading
+from neb import metrics
+from neb.cache import TTLCache
+from neb.engine import KeyValueStore
 from neb.plugins import Plugin, admin_only
-from Queue import PriorityQueue
-from threading import Thread
 
 
-import time
 import logging as log
 
-queue = PriorityQueue()
+
+class AlertGrouper(object):
+    """Collects alerts for a while so that they can be sent as one message.
+
+    Alerts are grouped by the values of some of their labels. The first alert
+    in a group starts a timer, and when it fires every alert which arrived in
+    the meantime is passed to the flush function.
+    """
+
+    def __init__(self, window_s, group_by, flush_fn, done_fn=None):
+        """Create the grouper.
+
+        Args:
+            window_s(float): The number of seconds to collect alerts for. If
+                0, alerts are flushed straight away.
+            group_by(list<str>): The labels to group alerts by.
+            flush_fn: The function to call with (group_labels, alerts) where
+                alerts is a list of (status, alert).
+            done_fn: Optional. The function to call with the list of tokens
+                given to add() once their alerts have been flushed.
+        """
+        self.window_s = window_s
+        self.group_by = group_by
+        self.flush_fn = flush_fn
+        self.done_fn = done_fn
+        self.groups = {
+        #    tuple of label values : list of (status, alert)
+        }
+        self.tokens = {
+        #    tuple of label values : list of tokens for the group's alerts
+        }
+        self.lock = threading.Lock()
+
+    def add(self, alert, status, token=None):
+        """Add an alert to its group.
+
+        Args:
+            alert(dict): The alert.
+            status(str): The alert's status.
+            token: Optional. Passed to done_fn once the alert is flushed.
+        """
+        labels = alert.get("labels", {})
+        key = tuple(labels.get(label) for label in self.group_by)
+        if self.window_s <= 0:
+            try:
+                self.flush_fn(self._group_labels(key), [(status, alert)])
+            finally:
+                self._done([token] if token is not None else [])
+            return
+
+        with self.lock:
+            if key not in self.groups:
+                self.groups[key] = []
+                self.tokens[key] = []
+                t = threading.Timer(self.window_s, self.flush, [key])
+                t.daemon = True
+                t.start()
+            self.groups[key].append((status, alert))
+            if token is not None:
+                self.tokens[key].append(token)
+
+    def pending_count(self):
+        """Return the number of alerts waiting to be sent."""
+        with self.lock:
+            return sum(len(alerts) for alerts in self.groups.values())
+
+    def flush(self, key):
+        with self.lock:
+            alerts = self.groups.pop(key, None)
+            tokens = self.tokens.pop(key, [])
+        if alerts:
+            try:
+                self.flush_fn(self._group_labels(key), alerts)
+            except Exception as e:
+                # not retried, as it would fail again
+                log.exception(e)
+        self._done(tokens)
+
+    def _done(self, tokens):
+        if tokens and self.done_fn:
+            try:
+                self.done_fn(tokens)
+            except Exception as e:
+                log.exception(e)
+
+    def _group_labels(self, key):
+        return dict(
+            (label, value) for (label, value) in zip(self.group_by, key)
+            if value is not None
+        )
+
+
+class LabelMatcher(object):
+    """Matches a label against a value, like 'severity=page' or
+    'team=~db|web'. Regexes must match the whole label value."""
+
+    def __init__(self, name, value, regex=False):
+        self.name = name
+        self.value = value
+        self.regex = regex
+        if regex:
+            try:
+                self.pattern = re.compile("(?:%s)$" % value)
+            except re.error as e:
+                raise ValueError("Bad regex %s: %s" % (value, e))
+
+    @classmethod
+    def parse(cls, matcher):
+        if "=~" in matcher:
+            (name, value) = matcher.split("=~", 1)
+            return LabelMatcher(name, value, regex=True)
+        elif "=" in matcher:
+            (name, value) = matcher.split("=", 1)
+            return LabelMatcher(name, value)
+        raise ValueError("Expected name=value or name=~regex: %s" % matcher)
+
+    def matches(self, labels):
+        value = labels.get(self.name, "")
+        if self.regex:
+            return self.pattern.match(value) is not None
+        return value == self.value
+
+
+class AlertRouter(object):
+    """Finds the rooms whose label matchers match an alert.
+
+    Each room is indexed under one of its equality matchers, so only the rooms
+    which could match an alert's labels are checked. Rooms with only regex
+    matchers are checked for every alert.
+    """
+
+    def __init__(self):
+        self.routes = {
+        #    (room_id, state_key) : list of LabelMatcher, all of which match
+        }
+        self.by_label = {
+        #    (label name, value) : set of (room_id, state_key)
+        }
+        self.unindexed = set()  # (room_id, state_key) to check every time
+        self.lock = threading.Lock()
+
+    def update(self, room_id, state_key, content):
+        """Replace a room's matchers. A RoomContextStore listener."""
+        key = (room_id, state_key)
+        with self.lock:
+            self._remove(key)
+            if content is None or "matchers" not in content:
+                return
+            try:
+                matchers = [
+                    LabelMatcher.parse(m) for m in content["matchers"]
+                ]
+            except (ValueError, AttributeError, TypeError) as e:
+                log.warn("Ignoring bad matchers in %s: %s", room_id, e)
+                return
+
+            self.routes[key] = matchers
+            equals = [m for m in matchers if not m.regex]
+            if equals:
+                self.by_label.setdefault(
+                    (equals[0].name, equals[0].value), set()
+                ).add(key)
+            else:
+                self.unindexed.add(key)
+
+    def get_room_ids(self, labels):
+        """Return the IDs of the rooms which want an alert with these labels."""
+        with self.lock:
+            candidates = set(self.unindexed)
+            for item in labels.items():
+                candidates.update(self.by_label.get(item, ()))
+            return set(
+                room_id for (room_id, state_key) in candidates
+                if all(m.matches(labels)
+                       for m in self.routes[(room_id, state_key)])
+            )
+
+    def _remove(self, key):
+        # must be called with self.lock held
+        matchers = self.routes.pop(key, None)
+        if matchers is None:
+            return
+        self.unindexed.discard(key)
+        for m in matchers:
+            if not m.regex:
+                keys = self.by_label.get((m.name, m.value))
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.by_label[(m.name, m.value)]
+                break  # only the first equality matcher is indexed
 
 
 class PrometheusPlugin(Plugin):
     """Plugin for interacting with Prometheus.
+    prometheus track matcher1 matcher2 ... : Display alerts whose labels match all the matchers, e.g. severity=page team=~db|web
+    prometheus track all : Display all alerts.
+    prometheus show track|tracking : Display the matchers for this room.
+    prometheus stop track|tracking : Stop displaying alerts.
+    prometheus templates : Display the alert templates and the one this room uses.
+    prometheus template name : Use the named template for alerts in this room.
     """
     name = "prometheus"
 
+    #New events:
+    #    Type: org.matrix.neb.plugin.prometheus.projects.tracking
+    #    State: Yes
+    #    Content: {
+    #        matchers: ["name=value", "name=~regex", ...]
+    #    }
+    #
+    #    Type: org.matrix.neb.plugin.prometheus.template
+    #    State: Yes
+    #    Content: {
+    #        name: templateName
+    #    }
+
     #Webhooks:
         #    /neb/prometheus
     TYPE_TRACK = "org.matrix.neb.plugin.prometheus.projects.tracking"
+    TYPE_TEMPLATE = "org.matrix.neb.plugin.prometheus.template"
+
+    # 'message_template' is the default template, and more can be named in
+    # 'templates'. An alert can pick one with this label.
+    DEFAULT_TEMPLATE = "default"
+    TEMPLATE_LABEL = "neb_template"
+
+    # the alerts which have been sent, so repeats are not sent again
+    SEEN_SIZE = 10000
+    SEEN_TTL_S = 60 * 60 * 24
 
+    # alerts are collected for a while and sent to each room as one digest
+    GROUP_WINDOW_S = 10
+    GROUP_BY = ["alertname", "severity"]
+    DIGEST_MAX_ALERTS = 10  # the max number of alerts listed in a digest
+
+    TRACKING = ["track", "tracking"]
+
+    # alerts which have been received but not yet sent
+    SPOOL_KIND = "prometheus.alert"
 
     def __init__(self, *args, **kwargs):
         super(PrometheusPlugin, self).__init__(*args, **kwargs)
         self.store = KeyValueStore("prometheus.json")
-        self.rooms = RoomContextStore(
-            [PrometheusPlugin.TYPE_TRACK]
+        self.rooms = self.room_store.view(
+            [PrometheusPlugin.TYPE_TRACK, PrometheusPlugin.TYPE_TEMPLATE]
+        )
+        # send alerts only to the rooms whose matchers match
+        self.router = AlertRouter()
+        self.rooms.add_listener(PrometheusPlugin.TYPE_TRACK, self.router.update)
+        if not self.store.has("templates"):
+            self.store.set("templates", {})
+        # templates are compiled once, and again only if they are changed
+        self.templates = SandboxedEnvironment(
+            loader=FunctionLoader(self._load_template),
+            bytecode_cache=FileSystemBytecodeCache(),
+            auto_reload=True
+        )
+        self.seen_alerts = TTLCache(
+            max_size=PrometheusPlugin.SEEN_SIZE,
+            ttl_s=PrometheusPlugin.SEEN_TTL_S
+        )
+        if not self.store.has("group_window_s"):
+            self.store.set("group_window_s", PrometheusPlugin.GROUP_WINDOW_S)
+        if not self.store.has("group_by"):
+            self.store.set("group_by", PrometheusPlugin.GROUP_BY)
+        # alerts waiting in a group are kept in the spool until they are sent
+        self.grouper = AlertGrouper(
+            self.store.get("group_window_s"),
+            self.store.get("group_by"),
+            self.send_alerts,
+            done_fn=self._ack_alerts
         )
-        self.queue_counter = 1L
-        self.consumer = MessageConsumer(self.matrix)
-        self.consumer.daemon = True
-        self.consumer.start()
+        metrics.QUEUE_DEPTH.labels("prometheus_alerts").set_function(
+            self.grouper.pending_count
+        )
+
+    def on_sync(self, response):
+        self._warn_if_untracked()
+
+    def on_restore(self, checkpoint):
+        self._warn_if_untracked()
+
+    def _warn_if_untracked(self):
+        # alerts used to be sent to every room, so point out upgrades which
+        # haven't set up tracking yet
+        room_ids = self.rooms.get_room_ids()
+        if room_ids and not self.rooms.get_room_ids_with(
+                PrometheusPlugin.TYPE_TRACK):
+            log.warn(
+                "None of the %s rooms track Prometheus alerts, so no alerts "
+                "will be sent. Run '!prometheus track all' in the rooms "
+                "which should get every alert.", len(room_ids)
+            )
+
+    @admin_only
+    def cmd_track(self, event, *args):
+        """Display alerts matching labels. 'prometheus track severity=page team=~db|web' or 'prometheus track all'"""
+        if len(args) == 0:
+            return self._get_tracking(event["room_id"])
+        if args == ("all",):
+            args = ()
+
+        for matcher in args:
+            try:
+                LabelMatcher.parse(matcher)
+            except ValueError as e:
+                return str(e)
+
+        self.matrix.send_state_event(
+            event["room_id"],
+            PrometheusPlugin.TYPE_TRACK,
+            {
+                "matchers": list(args)
+            }
+        )
+        if not args:
+            return "All alerts will be displayed."
+        return "Alerts matching %s will be displayed." % json.dumps(args)
+
+    def cmd_show(self, event, action):
+        """Show the matchers for this room. 'prometheus show tracking'"""
+        if action in self.TRACKING:
+            return self._get_tracking(event["room_id"])
 
-    def on_event(self, event, event_type):
-        self.rooms.update(event)
+    @admin_only
+    def cmd_stop(self, event, action):
+        """Stop displaying alerts. 'prometheus stop tracking'"""
+        if action in self.TRACKING:
+            # Use {} so we can still get the state; the router ignores rooms
+            # without matchers.
+            self.matrix.send_state_event(
+                event["room_id"],
+                PrometheusPlugin.TYPE_TRACK,
+                {}
+            )
+            return "Stopped displaying alerts."
 
-    def on_sync(self, sync):
-        log.debug("Plugin: Prometheus sync state:")
-        self.rooms.init_from_sync(sync)
+    def _get_tracking(self, room_id):
+        try:
+            matchers = self.rooms.get_content(
+                room_id, PrometheusPlugin.TYPE_TRACK
+            )["matchers"]
+            return "Displaying alerts matching %s" % json.dumps(matchers)
+        except KeyError:
+            return "Not displaying any alerts."
+
+    def cmd_templates(self, event):
+        """Show the alert templates. 'prometheus templates'"""
+        try:
+            name = self.rooms.get_content(
+                event["room_id"], PrometheusPlugin.TYPE_TEMPLATE
+            )["name"]
+        except KeyError:
+            name = PrometheusPlugin.DEFAULT_TEMPLATE
+        return "Templates: %s. This room uses '%s'." % (
+            json.dumps(self._get_template_names()), name
+        )
+
+    @admin_only
+    def cmd_template(self, event, name):
+        """Use a template for alerts in this room. 'prometheus template name'"""
+        if name not in self._get_template_names():
+            return "Unknown template: %s." % name
+
+        self.matrix.send_state_event(
+            event["room_id"],
+            PrometheusPlugin.TYPE_TEMPLATE,
+            {
+                "name": name
+            }
+        )
+        return "Alerts will be displayed using the '%s' template." % name
 
     def get_webhook_key(self):
         return "prometheus"
 
+    def get_webhook_dedup_key(self, url, data, ip, headers):
+        # alertmanager resends identical notifications
+        return sha1(data).hexdigest()
+
     def on_receive_webhook(self, url, data, ip, headers):
         json_data = json.loads(data)
         log.info("recv %s", json_data)
-        template = Template(self.store.get("message_template"))
-        for alert in json_data.get("alert", []):
-            for room_id in self.rooms.get_room_ids():
-                log.debug("queued message for room " + room_id + " at " + str(self.queue_counter) + ": %s", alert)
-                queue.put((self.queue_counter, room_id, template.render(alert)))
-                self.queue_counter += 1
-
-
-class MessageConsumer(Thread):
-    """ This class consumes the produced messages
-        also will try to resend the messages that
-        are failed for instance when the server was down.
-    """
+        # newer versions of alertmanager send 'alerts' with a status each
+        alerts = json_data.get("alerts", json_data.get("alert", []))
+        for alert in alerts:
+            status = alert.get("status", json_data.get("status"))
+            if not self.is_new_alert(alert, status):
+                log.debug("Dropping repeat alert %s", alert)
+                continue
+            spool_id = None
+            if self.spool:
+                # synced by the webhook pipeline before it acks the request
+                spool_id = self.spool.put(
+                    PrometheusPlugin.SPOOL_KIND,
+                    {"alert": alert, "status": status},
+                    sync=False
+                )
+            self.grouper.add(alert, status, token=spool_id)
 
-    INITIAL_TIMEOUT_S = 5
-    TIMEOUT_INCREMENT_S = 5
-    MAX_TIMEOUT_S = 60 * 5
+    def on_spool_replay(self, spool_id, kind, data):
+        if kind != PrometheusPlugin.SPOOL_KIND:
+            return super(PrometheusPlugin, self).on_spool_replay(
+                spool_id, kind, data
+            )
+        self.grouper.add(data["alert"], data["status"], token=spool_id)
 
-    def __init__(self, matrix):
-        super(MessageConsumer, self).__init__()
-        self.matrix = matrix
+    def _ack_alerts(self, spool_ids):
+        # the messages for the alerts must be on disk before we forget them
+        self.spool.sync()
+        for spool_id in spool_ids:
+            self.spool.ack(spool_id)
 
-    def run(self):
-        timeout = self.INITIAL_TIMEOUT_S
+    def send_alerts(self, group_labels, alerts):
+        """Send a group of alerts to the rooms which match them.
 
-        log.debug("Starting consumer thread")
-        while True:
-            priority, room_id, message = queue.get()
-            log.debug("Popped message for room " + room_id + " at position " + str(priority) + ": %s", message)
-            try:
-                self.send_message(room_id, message)
-                timeout = self.INITIAL_TIMEOUT_S
-            except Exception as e:
-                log.debug("Failed to send message: %s", e)
-                queue.put((priority, room_id, message))
+        Args:
+            group_labels(dict): The labels which the alerts have in common.
+            alerts(list): A list of (status, alert).
+        """
+        room_alerts = {
+        #    room_id : list of indexes into alerts
+        }
+        for (i, (status, alert)) in enumerate(alerts):
+            for room_id in self.router.get_room_ids(alert.get("labels", {})):
+                room_alerts.setdefault(room_id, []).append(i)
 
-                time.sleep(timeout)
-                timeout += self.TIMEOUT_INCREMENT_S
-                if timeout > self.MAX_TIMEOUT_S:
-                    timeout = self.MAX_TIMEOUT_S
+        messages = {
+        #    (template name, alert index) or tuple of alert indexes : message
+        }
+        for room_id in room_alerts:
+            indexes = room_alerts[room_id]
+            if len(indexes) == 1:
+                alert = alerts[indexes[0]][1]
+                key = (self._get_template_name(room_id, alert), indexes[0])
+                if key not in messages:
+                    messages[key] = self.render_alert(key[0], alert)
+            else:
+                key = tuple(indexes)
+                if key not in messages:
+                    messages[key] = self.render_digest(
+                        group_labels, [alerts[i] for i in indexes]
+                    )
+            log.debug("queued message for room %s: %s", room_id, key)
+            self.outbox.send_html(room_id, messages[key])
 
-    def send_message(self, room_id, message):
+    def render_alert(self, name, alert):
+        """Render an alert with the named template, or the default one if
+        there is no such template."""
         try:
-            self.matrix.send_message_event(
-                    room_id,
-                    "m.room.message",
-                    self.matrix.get_html_body(message, msgtype="m.notice"),
+            template = self.templates.get_template(name)
+        except TemplateNotFound:
+            log.warn("Unknown template '%s', using the default", name)
+            template = self.templates.get_template(
+                PrometheusPlugin.DEFAULT_TEMPLATE
             )
+        return template.render(alert)
+
+    def render_digest(self, group_labels, alerts):
+        """Render a summary of a group of alerts as HTML."""
+        counts = {}
+        for (status, alert) in alerts:
+            counts[status] = counts.get(status, 0) + 1
+
+        lines = ["<b>[ALERT] %s</b>: %s" % (
+            cgi.escape(", ".join(
+                "%s=%s" % (k, group_labels[k]) for k in sorted(group_labels)
+            ) or "ungrouped"),
+            ", ".join(
+                "%s %s" % (counts[status], status) for status in sorted(counts)
+            )
+        )]
+        for (status, alert) in alerts[:PrometheusPlugin.DIGEST_MAX_ALERTS]:
+            labels = alert.get("labels", {})
+            lines.append("%s: %s" % (status, cgi.escape(", ".join(
+                "%s=%s" % (k, labels[k]) for k in sorted(labels)
+                if k not in group_labels
+            ))))
+        if len(alerts) > PrometheusPlugin.DIGEST_MAX_ALERTS:
+            lines.append("...and %s more" % (
+                len(alerts) - PrometheusPlugin.DIGEST_MAX_ALERTS
+            ))
+        return "<br/>".join(lines)
+
+    def _get_template_name(self, room_id, alert):
+        name = alert.get("labels", {}).get(PrometheusPlugin.TEMPLATE_LABEL)
+        if name:
+            return name
+        try:
+            return self.rooms.get_content(
+                room_id, PrometheusPlugin.TYPE_TEMPLATE
+            )["name"]
         except KeyError:
-            log.error(KeyError)
-        except MatrixRequestError as e:
-            if 400 <= e.code < 500:
-                log.error("Matrix ignored message %s", e)
-            else:
-                raise
+            return PrometheusPlugin.DEFAULT_TEMPLATE
+
+    def _get_template_names(self):
+        return [PrometheusPlugin.DEFAULT_TEMPLATE] + sorted(
+            self.store.get("templates").keys()
+        )
+
+    def _get_template_source(self, name):
+        if name == PrometheusPlugin.DEFAULT_TEMPLATE:
+            return self.store.get("message_template")
+        return self.store.get("templates")[name]
+
+    def _load_template(self, name):
+        # for the jinja loader: returns (source, filename, uptodate)
+        try:
+            source = self._get_template_source(name)
+        except KeyError:
+            return None
+
+        def uptodate():
+            try:
+                return self._get_template_source(name) == source
+            except KeyError:
+                return False
+        return (source, None, uptodate)
+
+    def is_new_alert(self, alert, status):
+        """Check if an alert has changed status since it was last sent.
+
+        Args:
+            alert(dict): The alert from the webhook.
+            status(str): The alert's status, e.g. 'firing' or 'resolved'.
+        Returns:
+            bool: True if the alert should be sent.
+        """
+        fingerprint = alert.get("fingerprint")
+        if not fingerprint:
+            fingerprint = sha1(
+                json.dumps(alert.get("labels", {}), sort_keys=True)
+            ).hexdigest()
+        # forget the previous status, so the alert is sent if it goes back
+        for other in ["firing", "resolved"]:
+            if other != status:
+                self.seen_alerts.invalidate("%s/%s" % (fingerprint, other))
+        return self.seen_alerts.add("%s/%s" % (fingerprint, status))
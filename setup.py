@@ -15,6 +15,10 @@ setup(
         "Flask",
         "python-dateutil"
     ],
+    extras_require = {
+        "stream": ["ijson"],
+        "server": ["waitress"]
+    },
     dependency_links=[
         "https://github.com/matrix-org/matrix-python-sdk/tarball/v0.0.5#egg=matrix_client-0.0.5"
     ]
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import threading
+import unittest
+
+from matrix_client.api import MatrixRequestError
+from neb.outbox import Outbox
+from neb.spool import Spool
+
+
+class FakeMatrix(object):
+    """Records sent messages, failing the first few sends."""
+
+    def __init__(self, failures=None):
+        self.failures = list(failures or [])  # MatrixRequestErrors to raise
+        self.attempts = []  # (room_id, body, txn_id) for every send
+        self.lock = threading.Lock()
+
+    def get_text_body(self, text, msgtype="m.text"):
+        return {"msgtype": msgtype, "body": text}
+
+    def send_message_event(self, room_id, event_type, content, txn_id=None):
+        with self.lock:
+            self.attempts.append((room_id, content["body"], txn_id))
+            if self.failures:
+                raise self.failures.pop(0)
+        return {"event_id": "$%s" % txn_id}
+
+
+class OutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory)
+        # retry quickly
+        self.backoff = (Outbox.INITIAL_BACKOFF_S, Outbox.BACKOFF_INCREMENT_S)
+        Outbox.INITIAL_BACKOFF_S = Outbox.BACKOFF_INCREMENT_S = 0.05
+
+    def tearDown(self):
+        (Outbox.INITIAL_BACKOFF_S, Outbox.BACKOFF_INCREMENT_S) = self.backoff
+        shutil.rmtree(self.directory)
+
+    def _outbox(self, matrix):
+        return Outbox(matrix, {"rate_per_s": 100, "burst": 100},
+                      spool=self.spool)
+
+    def test_retries_with_the_same_txn_id_until_accepted(self):
+        matrix = FakeMatrix([
+            MatrixRequestError(code=500, content="oops"),
+            MatrixRequestError(code=502, content="oops")
+        ])
+        outbox = self._outbox(matrix)
+        outbox.send_message("!r", "hello")
+        self.assertEqual(self.spool.pending_count(), 1)
+
+        self.assertTrue(outbox.wait_empty(timeout=5))
+        self.assertEqual(len(matrix.attempts), 3)
+        self.assertEqual(len(set(a[2] for a in matrix.attempts)), 1)
+        self.assertEqual(self.spool.pending_count(), 0)
+
+    def test_retries_rate_limited_messages(self):
+        matrix = FakeMatrix([
+            MatrixRequestError(
+                code=429, content='{"retry_after_ms": 10}'
+            )
+        ])
+        outbox = self._outbox(matrix)
+        outbox.send_message("!r", "hello")
+
+        self.assertTrue(outbox.wait_empty(timeout=5))
+        self.assertEqual(len(matrix.attempts), 2)
+        self.assertEqual(self.spool.pending_count(), 0)
+
+    def test_drops_and_acks_rejected_messages(self):
+        matrix = FakeMatrix([MatrixRequestError(code=403, content="no")])
+        outbox = self._outbox(matrix)
+        outbox.send_message("!r", "hello")
+
+        self.assertTrue(outbox.wait_empty(timeout=5))
+        self.assertEqual(len(matrix.attempts), 1)
+        self.assertEqual(self.spool.pending_count(), 0)
+
+    def test_unsent_messages_are_replayed_after_restart(self):
+        matrix = FakeMatrix([
+            MatrixRequestError(code=500, content="oops")
+        ] * 1000)
+        outbox = Outbox(matrix, {"workers": 0}, spool=self.spool)
+        outbox.send_message("!r", "first")
+        outbox.send_message("!r", "second")
+        self.spool.sync()
+
+        spool = Spool(self.directory)
+        matrix = FakeMatrix()
+        outbox = Outbox(matrix, {"max_coalesce": 1}, spool=spool)
+        for (spool_id, kind, data) in spool.replay():
+            self.assertEqual(kind, Outbox.SPOOL_KIND)
+            outbox.send_content(
+                data["room_id"], data["content"], spool_id=spool_id
+            )
+
+        self.assertTrue(outbox.wait_empty(timeout=5))
+        self.assertEqual(
+            [a[1] for a in matrix.attempts], ["first", "second"]
+        )
+        # replayed messages are acked rather than spooled again
+        self.assertEqual(spool.pending_count(), 0)
+        self.assertEqual(list(Spool(self.directory).replay()), [])
+
+    def test_merged_messages_ack_every_spool_entry(self):
+        matrix = FakeMatrix()
+        outbox = Outbox(matrix, {"workers": 0}, spool=self.spool)
+        for i in range(3):
+            outbox.send_message("!r", "msg %s" % i)
+        # send them all as one message
+        with outbox.cond:
+            msg, wait_s = outbox._next_message()
+        outbox._send(msg)
+
+        self.assertEqual(
+            [a[1] for a in matrix.attempts], ["msg 0\nmsg 1\nmsg 2"]
+        )
+        self.assertEqual(self.spool.pending_count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
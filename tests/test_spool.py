@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+
+from neb.spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _segments(self):
+        return sorted(
+            n for n in os.listdir(self.directory) if n.endswith(".log")
+        )
+
+    def _replay(self, spool):
+        return [(kind, data) for (entry_id, kind, data) in spool.replay()]
+
+    def test_replays_unacked_entries_in_order_after_restart(self):
+        spool = Spool(self.directory)
+        ids = [spool.put("k", {"n": n}) for n in range(4)]
+        spool.ack(ids[1])
+
+        spool = Spool(self.directory)
+        self.assertEqual(
+            self._replay(spool),
+            [("k", {"n": 0}), ("k", {"n": 2}), ("k", {"n": 3})]
+        )
+        self.assertEqual(spool.pending_count(), 3)
+
+    def test_does_not_replay_entries_put_after_opening(self):
+        spool = Spool(self.directory)
+        spool.put("k", "old")
+        spool = Spool(self.directory)
+        spool.put("k", "new")
+        self.assertEqual(self._replay(spool), [("k", "old")])
+
+    def test_acked_replayed_entries_are_not_replayed_again(self):
+        spool = Spool(self.directory)
+        spool.put("k", "a")
+        spool.put("k", "b")
+
+        spool = Spool(self.directory)
+        for (entry_id, kind, data) in spool.replay():
+            if data == "a":
+                spool.ack(entry_id)
+
+        spool = Spool(self.directory)
+        self.assertEqual(self._replay(spool), [("k", "b")])
+
+    def test_ignores_torn_trailing_record(self):
+        spool = Spool(self.directory)
+        spool.put("k", "a")
+        spool.put("k", "b")
+        # a crash part way through writing a record
+        with open(os.path.join(self.directory, self._segments()[-1]), "a") as f:
+            f.write('{"op": "put", "id": 3, "ki')
+
+        spool = Spool(self.directory)
+        self.assertEqual(self._replay(spool), [("k", "a"), ("k", "b")])
+        entry_id = spool.put("k", "c")
+
+        # new records go to a new segment, so they aren't joined to the
+        # torn one
+        spool = Spool(self.directory)
+        self.assertEqual(
+            self._replay(spool), [("k", "a"), ("k", "b"), ("k", "c")]
+        )
+        self.assertEqual(
+            [e[0] for e in spool.replay()][-1], entry_id
+        )
+
+    def test_compacts_only_from_the_front(self):
+        # one record per segment
+        spool = Spool(self.directory, segment_bytes=1)
+        first = spool.put("k", "a")
+        second = spool.put("k", "b")
+        segments = self._segments()
+
+        spool.ack(second)
+        # the segment with 'b' is fully acked, but the one before it isn't,
+        # so neither is removed
+        self.assertTrue(set(segments) <= set(self._segments()))
+
+        spool = Spool(self.directory, segment_bytes=1)
+        self.assertEqual(self._replay(spool), [("k", "a")])
+
+        spool.ack(first)
+        self.assertEqual(len(self._segments()), 1)  # the one being written
+
+        spool = Spool(self.directory, segment_bytes=1)
+        self.assertEqual(self._replay(spool), [])
+        self.assertEqual(spool.pending_count(), 0)
+
+    def test_unsynced_puts_are_durable_after_sync(self):
+        spool = Spool(self.directory)
+        spool.put("k", "a", sync=False)
+        spool.sync()
+        self.assertEqual(spool.synced, spool.written)
+
+        spool = Spool(self.directory)
+        self.assertEqual(self._replay(spool), [("k", "a")])
+
+
+if __name__ == '__main__':
+    unittest.main()
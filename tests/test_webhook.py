@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from neb.spool import Spool
+from neb.webhook import WebhookPipeline, WebhookRequest
+from werkzeug.datastructures import Headers
+
+
+class RecordingPlugin(object):
+
+    def __init__(self):
+        self.received = []
+        self.lock = threading.Lock()
+
+    def on_receive_webhook(self, url, data, ip, headers):
+        time.sleep(0.001)
+        with self.lock:
+            self.received.append(data)
+
+
+class WebhookPipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.plugin = RecordingPlugin()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _request(self, data):
+        return WebhookRequest("k", self.plugin, "/neb/k", data, "127.0.0.1",
+                              Headers())
+
+    def _wait_for(self, count):
+        end = time.time() + 5
+        while len(self.plugin.received) < count and time.time() < end:
+            time.sleep(0.01)
+
+    def test_replays_spooled_requests_in_order_before_new_ones(self):
+        spool = Spool(self.directory)
+        pipeline = WebhookPipeline({"workers": 0}, spool=spool)
+        for i in range(20):
+            pipeline.submit(self._request("old %s" % i))
+
+        spool = Spool(self.directory)
+        pipeline = WebhookPipeline({"workers": 4}, spool=spool)
+        # arrives whilst the spool is being replayed
+        pipeline.submit(self._request("new"))
+        for (spool_id, kind, data) in spool.replay():
+            self.assertEqual(kind, WebhookPipeline.SPOOL_KIND)
+            req = WebhookRequest.from_json(self.plugin, data)
+            req.spool_id = spool_id
+            pipeline.replay(req)
+        self.assertEqual(
+            self.plugin.received, ["old %s" % i for i in range(20)]
+        )
+
+        pipeline.start()
+        self._wait_for(21)
+        self.assertEqual(self.plugin.received[-1], "new")
+        self._wait_for_acks(spool)
+
+    def _wait_for_acks(self, spool):
+        end = time.time() + 5
+        while spool.pending_count() and time.time() < end:
+            time.sleep(0.01)
+        self.assertEqual(spool.pending_count(), 0)
+
+    def test_rejects_requests_when_the_queue_is_full(self):
+        spool = Spool(self.directory)
+        pipeline = WebhookPipeline({"max_queue": 1}, spool=spool)
+        self.assertTrue(pipeline.submit(self._request("a")))
+        self.assertFalse(pipeline.submit(self._request("b")))
+        # the sender retries rejected requests, so they aren't spooled
+        self.assertEqual(spool.pending_count(), 1)
+        self.assertEqual(pipeline.get_stats()["rejected"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()